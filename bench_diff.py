@@ -0,0 +1,88 @@
+import difflib
+import os
+import random
+import time
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mfgd.settings")
+import django
+
+django.setup()
+from mfgd_app.diff import diff_stats, split_lines
+
+def prose_lines(count, rng):
+    return [b"line %d %08x\n" % (i, rng.getrandbits(32)) for i in range(count)]
+
+
+def code_lines(count, distinct, rng):
+    """Source-like lines, most of them drawn from a small set of repeated ones"""
+    common = [b"    x%d = f(y%d)\n" % (k, k * 7) for k in range(distinct)]
+    return [
+        rng.choice(common) if rng.random() < 0.7 else b"    z = g(%d)\n" % i
+        for i in range(count)
+    ]
+
+
+def edit(lines, edits, rng):
+    """Scatter replaced, inserted and deleted lines over a copy of lines"""
+    lines = list(lines)
+    for pos in sorted(rng.sample(range(len(lines)), edits), reverse=True):
+        kind = rng.randrange(3)
+        if kind == 0:
+            lines[pos] = b"changed %08x\n" % rng.getrandbits(32)
+        elif kind == 1:
+            lines.insert(pos, b"inserted %08x\n" % rng.getrandbits(32))
+        else:
+            del lines[pos]
+    return lines
+
+
+def difflib_stats(a, b):
+    """Line counts from the difflib diff the commit page used to produce"""
+    a = [line.decode() for line in a]
+    b = [line.decode() for line in b]
+    insertions = deletions = 0
+    for line in difflib.unified_diff(a, b, n=3):
+        if line.startswith("+") and not line.startswith("+++"):
+            insertions += 1
+        elif line.startswith("-") and not line.startswith("---"):
+            deletions += 1
+    return insertions, deletions
+
+
+def bench(name, func, a, b):
+    start = time.perf_counter()
+    result = func(a, b)
+    elapsed = time.perf_counter() - start
+    print(f"[*] {name}: {elapsed:.3f}s, {result[0]} insertions, {result[1]} deletions")
+    return elapsed
+
+
+def main():
+    rng = random.Random(0)
+    cases = [
+        ("50k lines, 500 edits", prose_lines(50000, rng), 500),
+        ("200k lines, 500 edits", prose_lines(200000, rng), 500),
+        ("20k lines of code, 400 edits", code_lines(20000, 100, rng), 400),
+        ("50k lines of code, 500 edits", code_lines(50000, 200, rng), 500),
+    ]
+    for name, a, edits in cases:
+        b = edit(a, edits, rng)
+        print(f"[*] {name}")
+        new = bench("diff_stats", diff_stats, a, b)
+        old = bench("difflib", difflib_stats, a, b)
+        print(f"[*] speedup: {old / new:.1f}x")
+
+    a = prose_lines(2000, rng)
+    b = [b"rewritten " + line for line in a]
+    print("[*] 2000 line rewrite")
+    bench("diff_stats", diff_stats, a, b)
+    bench("difflib", difflib_stats, a, b)
+
+    data = open(__file__, "rb").read()
+    if diff_stats(split_lines(data), split_lines(data)) != (0, 0):
+        raise SystemExit("[ KO ] identical files differ")
+    print("[ OK ] done")
+
+
+if __name__ == "__main__":
+    main()
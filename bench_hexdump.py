@@ -0,0 +1,73 @@
+import binascii
+import os
+import string
+import sys
+import time
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mfgd.settings")
+import django
+
+django.setup()
+from mfgd_app.utils import hex_dump
+
+
+BLOB_SIZE = 10 << 20
+# Size of one page of the binary blob view
+WINDOW_SIZE = 16 << 10
+
+
+def legacy_hex_dump(binary):
+    """The byte at a time hex dump hex_dump replaced, kept for comparison"""
+    ALLOWED_CHARS = set(string.ascii_letters + string.digits + string.punctuation)
+    N_BYTES_ROW = 16
+    N_BYTES_COL = 8
+    N_BYTES_CHUNK = 1
+
+    rows = []
+    for row_off in range(0, len(binary), N_BYTES_ROW):
+        row = binary[row_off : row_off + N_BYTES_ROW]
+        chunks = []
+        ascii = ""
+        for chunk_off in range(0, len(row), N_BYTES_CHUNK):
+            chunk = row[chunk_off : chunk_off + N_BYTES_CHUNK]
+            for char in map(chr, chunk):
+                if char in ALLOWED_CHARS:
+                    ascii += char
+                else:
+                    ascii += "."
+            chunks.append(binascii.b2a_hex(chunk).decode())
+
+        cols = []
+        for col_off in range(0, len(chunks), N_BYTES_COL):
+            cols.append(" ".join(chunks[col_off : col_off + N_BYTES_COL]))
+
+        offset = "{:08x}".format(row_off)
+        rows.append((offset, cols, ascii))
+    return rows
+
+
+def bench(name, func, blob):
+    start = time.perf_counter()
+    rows = func(blob)
+    elapsed = time.perf_counter() - start
+    print(f"[*] {name}: {elapsed:.2f}s, {len(blob) / elapsed / (1 << 20):.1f} MiB/s")
+    return rows
+
+
+def main():
+    blob = os.urandom(BLOB_SIZE)
+    print(f"[*] dumping a {BLOB_SIZE >> 20} MiB blob")
+    new = bench("hex_dump", hex_dump, blob)
+    old = bench("legacy_hex_dump", legacy_hex_dump, blob)
+    if new != old:
+        sys.exit("[ KO ] outputs differ")
+    print("[ OK ] outputs match")
+
+    start = time.perf_counter()
+    hex_dump(blob, BLOB_SIZE // 2, WINDOW_SIZE)
+    elapsed = time.perf_counter() - start
+    print(f"[*] hex_dump of one {WINDOW_SIZE >> 10} KiB page: {elapsed * 1000:.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -49,6 +49,7 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "mfgd_app.middleware.ObjectStatsMiddleware",
 ]
 
 ROOT_URLCONF = "mfgd.urls"
@@ -130,3 +131,121 @@ MEDIA_URL = "/media/"
 
 STATICFILES_DIRS = [BASE_DIR / "static"]
 STATIC_URL = "/static/"
+
+# Per-repository indexes of the commit that last changed each path
+CHANGE_INDEX_DIR = BASE_DIR / "cache" / "changes"
+
+# Number of open repositories kept around between requests
+REPOSITORY_POOL_SIZE = 32
+
+# Memory budget for parsed git objects shared by all repositories, blobs
+# larger than OBJECT_CACHE_MAX_BLOB are never cached
+OBJECT_CACHE_BYTES = 64 << 20
+OBJECT_CACHE_MAX_BLOB = 1 << 20
+
+# Memory budget for reconstructed delta bases, like git's
+# core.deltaBaseCacheLimit
+DELTA_BASE_CACHE_LIMIT = 96 << 20
+
+# Commits per page of the commit log, and how many paused log walks are kept
+# so following pages continue without walking from the tip again
+CHAIN_PAGE_SIZE = 100
+CHAIN_MAX_PAGE_SIZE = 500
+PAUSED_WALKS = 64
+
+# Highlighted source kept in memory by each worker and on disk for all of them
+HIGHLIGHT_CACHE_DIR = BASE_DIR / "cache" / "highlight"
+HIGHLIGHT_CACHE_MEMORY_BYTES = 32 << 20
+HIGHLIGHT_CACHE_DISK_BYTES = 512 << 20
+
+# Number of objects whose type, size and binary-ness are remembered
+OBJECT_INFO_CACHE_SIZE = 1 << 16
+
+# Diff algorithm for commit pages, "histogram" or "myers", and the limits past
+# which a file is shown as too large to diff
+DIFF_ALGORITHM = "histogram"
+DIFF_MAX_FILE_BYTES = 1 << 20
+DIFF_MAX_FILE_SECONDS = 2.0
+
+# Most added/source file pairs compared by content to find renames and copies,
+# and the time spent comparing them, past either only renames of identical
+# files are detected
+DIFF_RENAME_CANDIDATES = 1 << 16
+DIFF_RENAME_SECONDS = 1.0
+
+# Time the commit page spends detecting renames and counting changed lines
+# before listing the rest of the files without stats, files with more changed
+# lines than DIFF_COLLAPSE_LINES are collapsed until their diff is asked for,
+# and change lists of this many recent commits are kept for the per-file diff
+# requests
+DIFF_STATS_BUDGET_SECONDS = 2.0
+DIFF_COLLAPSE_LINES = 500
+DIFF_CHANGES_CACHE_SIZE = 64
+
+# Seconds browsers and proxies may reuse pages addressed by a full commit id,
+# which never change, and pages addressed by a branch name, which move
+COMMIT_PAGE_MAX_AGE = 365 * 24 * 60 * 60
+BRANCH_PAGE_MAX_AGE = 60
+# Pages a time budget cut short are not stored and may only be reused briefly
+INCOMPLETE_PAGE_MAX_AGE = 5
+
+# Rendered tree, blob and commit pages are kept in the PAGE_CACHE_ALIAS cache,
+# any backend works, pages larger than PAGE_CACHE_MAX_ENTRY_BYTES are not kept
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "pages": {
+        "BACKEND": "mfgd_app.cachebackends.SizedLocMemCache",
+        "TIMEOUT": None,
+        "OPTIONS": {
+            "MAX_ENTRIES": 10000,
+            "MAX_BYTES": 128 << 20,
+        },
+    },
+}
+PAGE_CACHE_ALIAS = "pages"
+PAGE_CACHE_MAX_ENTRY_BYTES = 1 << 20
+
+# Per-user repository permissions are cached here, changes to repositories or
+# access grants invalidate them at once when the cache is shared between
+# workers. A per-process cache like the default LocMemCache only keeps them
+# for PERMISSION_LOCAL_CACHE_TIMEOUT seconds, so other workers catch up quickly
+PERMISSION_CACHE_ALIAS = "default"
+PERMISSION_CACHE_TIMEOUT = 60
+PERMISSION_LOCAL_CACHE_TIMEOUT = 2
+
+# Users per page of a repository's permission matrix
+MANAGE_USERS_PAGE_SIZE = 50
+
+# Repositories per page of the dashboard and the repository management page
+DASHBOARD_PAGE_SIZE = 50
+
+# Number of repositories whose refs are kept in memory
+REF_TABLE_CACHE_SIZE = 256
+
+# Branches embedded in the branch selector of tree and blob pages, the rest
+# are found through the ref search endpoint in pages of REF_SEARCH_PAGE_SIZE
+BRANCH_SELECTOR_RECENT = 10
+REF_SEARCH_PAGE_SIZE = 50
+
+# Entries per page of a directory listing, and the most a request may ask for
+TREE_PAGE_SIZE = 500
+TREE_MAX_PAGE_SIZE = 2000
+
+# Debug builds log per-request object counters of streamed pages
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {
+        "console": {
+            "class": "logging.StreamHandler",
+        },
+    },
+    "loggers": {
+        "mfgd_app": {
+            "handlers": ["console"],
+            "level": "DEBUG" if DEBUG else "INFO",
+        },
+    },
+}
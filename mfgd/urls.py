@@ -25,13 +25,22 @@ from django.conf.urls.static import static
 urlpatterns = [
     path("", views.index, name="index"),
     re_path(
-        r"(?P<repo_name>[-_.\w]+)/view/(?P<oid>\w+)/(?P<path>\S*)/?", views.view, name="view"
+        r"^(?P<repo_name>[-_.\w]+)/view/(?P<oid>\w+)/(?P<path>\S*)/?$", views.view, name="view"
     ),
-    re_path(r"(?P<repo_name>[-_.\w]+)/view/?", views.view_default, name="view_default"),
-    re_path(r"(?P<repo_name>[-_.\w]+)/info/(?P<oid>\w+)/?", views.info, name="info"),
-    re_path(r"(?P<repo_name>[-_.\w]+)/chain/(?P<oid>\w+)/?", views.chain, name="chain"),
-    re_path(r"(?P<repo_name>[-_.\w]+)/chain/?", views.chain_default, name="chain_default"),
-    re_path(r"(?P<repo_name>[-_.\w]+)/manage/?", views.manage_repo, name="manage_repo"),
+    re_path(r"^(?P<repo_name>[-_.\w]+)/view/?$", views.view_default, name="view_default"),
+    re_path(
+        r"^(?P<repo_name>[-_.\w]+)/raw/(?P<oid>\w+)/(?P<path>\S*)/?$", views.raw, name="raw"
+    ),
+    re_path(r"^(?P<repo_name>[-_.\w]+)/info/(?P<oid>\w+)/?$", views.info, name="info"),
+    re_path(
+        r"^(?P<repo_name>[-_.\w]+)/diff/(?P<oid>\w+)/(?P<path>\S*)/?$",
+        views.file_diff,
+        name="file_diff",
+    ),
+    re_path(r"^(?P<repo_name>[-_.\w]+)/chain/(?P<oid>\w+)/?$", views.chain, name="chain"),
+    re_path(r"^(?P<repo_name>[-_.\w]+)/refs/?$", views.ref_search, name="ref_search"),
+    re_path(r"^(?P<repo_name>[-_.\w]+)/chain/?$", views.chain_default, name="chain_default"),
+    re_path(r"^(?P<repo_name>[-_.\w]+)/manage/?$", views.manage_repo, name="manage_repo"),
     path("admin/", admin.site.urls),
     path("logout/", views.user_logout, name="logout"),
     path("login/", views.user_login, name="login"),
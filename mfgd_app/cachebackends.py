@@ -0,0 +1,26 @@
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.locmem import LocMemCache
+
+
+class SizedLocMemCache(LocMemCache):
+    """Local memory cache that is also bounded by the size of its values
+
+    Takes a MAX_BYTES option on top of LocMemCache's. Past it the least
+    recently used entries are dropped, so a few large pages can not push the
+    process far beyond its budget the way counting entries alone would allow.
+    """
+
+    def __init__(self, name, params):
+        super().__init__(name, params)
+        self._max_bytes = int(params.get("OPTIONS", {}).get("MAX_BYTES", 64 << 20))
+
+    def _set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        super()._set(key, value, timeout)
+        # Recounted on every write as entries also disappear by expiry and
+        # culling, writes are rare next to reads
+        resident = sum(len(pickled) for pickled in self._cache.values())
+        # The most recently used entry is kept first, evict from the end
+        while resident > self._max_bytes and len(self._cache) > 1:
+            evicted_key, pickled = self._cache.popitem()
+            del self._expire_info[evicted_key]
+            resident -= len(pickled)
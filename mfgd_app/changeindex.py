@@ -0,0 +1,57 @@
+import hashlib
+import sqlite3
+import threading
+
+from django.conf import settings
+
+_local = threading.local()
+
+
+class ChangeIndex:
+    """On-disk map of (commit oid, path) to the commit that last changed it
+
+    Each repository gets its own SQLite file. Entries are only ever added,
+    since the answer for a given commit and path can never change.
+    """
+
+    def __init__(self, repo_path):
+        index_dir = settings.CHANGE_INDEX_DIR
+        index_dir.mkdir(parents=True, exist_ok=True)
+        name = hashlib.sha1(str(repo_path).encode()).hexdigest()
+        self.conn = sqlite3.connect(index_dir / f"{name}.sqlite3", timeout=5)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS changes ("
+            "commit_oid TEXT, dir TEXT, name TEXT, change_oid TEXT, "
+            "PRIMARY KEY (commit_oid, dir, name))"
+        )
+        self.conn.commit()
+
+    def lookup(self, commit_oid, parts, names):
+        """Return {name: change oid} for the indexed subset of names"""
+        rows = self.conn.execute(
+            "SELECT name, change_oid FROM changes WHERE commit_oid = ? AND dir = ?",
+            (commit_oid, "/".join(parts)),
+        )
+        return {name: change for name, change in rows if name in names}
+
+    def store(self, commit_oid, parts, changes):
+        dir = "/".join(parts)
+        try:
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO changes VALUES (?, ?, ?, ?)",
+                    ((commit_oid, dir, name, change) for name, change in changes.items()),
+                )
+        except sqlite3.OperationalError:
+            # The index is only a cache, a busy database just means a miss later
+            pass
+
+
+def open_index(repo_path):
+    """Get this thread's index for a repository, opening it on first use"""
+    if not hasattr(_local, "indexes"):
+        _local.indexes = {}
+    if repo_path not in _local.indexes:
+        _local.indexes[repo_path] = ChangeIndex(repo_path)
+    return _local.indexes[repo_path]
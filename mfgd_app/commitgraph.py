@@ -0,0 +1,99 @@
+import mmap
+import os
+import struct
+
+GRAPH_PARENT_NONE = 0x70000000
+GRAPH_EXTRA_EDGES = 0x80000000
+GRAPH_LAST_EDGE = 0x80000000
+
+
+class GraphCommit:
+    """A commit as recorded in the commit-graph, without its message"""
+
+    def __init__(self, oid, tree, parents, timestamp, generation):
+        self.oid = oid
+        self.tree = tree
+        self.parents = parents
+        self.timestamp = timestamp
+        self.generation = generation
+
+
+class CommitGraph:
+    """Memory-mapped .git/objects/info/commit-graph file
+
+    Gives the tree, parents, committer date and generation number of every
+    commit it covers without inflating the commit objects.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, hash_version, n_chunks = struct.unpack_from(">4sBBB", self.map, 0)
+        if signature != b"CGPH" or version != 1 or hash_version != 1:
+            raise ValueError(f"unsupported commit-graph {path}")
+
+        chunks = {}
+        for i in range(n_chunks):
+            chunk_id, offset = struct.unpack_from(">4sQ", self.map, 8 + i * 12)
+            chunks[chunk_id] = offset
+        self.fanout = struct.unpack_from(">256I", self.map, chunks[b"OIDF"])
+        self.count = self.fanout[255]
+        self.oid_base = chunks[b"OIDL"]
+        self.data_base = chunks[b"CDAT"]
+        self.edge_base = chunks.get(b"EDGE")
+
+    def position(self, oid):
+        """Position of the commit with binary oid in the graph, or None"""
+        first = oid[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self.oid_base + mid * 20
+            cur = self.map[pos : pos + 20]
+            if cur < oid:
+                lo = mid + 1
+            elif cur > oid:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def oid(self, position):
+        pos = self.oid_base + position * 20
+        return self.map[pos : pos + 20].hex()
+
+    def commit(self, oid):
+        """Look up a commit by hex oid, None if the graph does not cover it"""
+        position = self.position(bytes.fromhex(oid))
+        if position is None:
+            return None
+
+        pos = self.data_base + position * 36
+        tree = self.map[pos : pos + 20].hex()
+        parent1, parent2, date_high, date_low = struct.unpack_from(">IIII", self.map, pos + 20)
+
+        parents = []
+        if parent1 != GRAPH_PARENT_NONE:
+            parents.append(self.oid(parent1))
+        if parent2 & GRAPH_EXTRA_EDGES:
+            edge = parent2 & ~GRAPH_EXTRA_EDGES
+            while True:
+                (parent,) = struct.unpack_from(">I", self.map, self.edge_base + edge * 4)
+                parents.append(self.oid(parent & ~GRAPH_LAST_EDGE))
+                if parent & GRAPH_LAST_EDGE:
+                    break
+                edge += 1
+        elif parent2 != GRAPH_PARENT_NONE:
+            parents.append(self.oid(parent2))
+
+        timestamp = ((date_high & 3) << 32) | date_low
+        return GraphCommit(oid, tree, parents, timestamp, date_high >> 2)
+
+
+def open_graph(path):
+    """Open a repository's commit-graph, or None if it has not been written"""
+    graph_path = os.path.join(path, ".git", "objects", "info", "commit-graph")
+    if not os.path.exists(graph_path):
+        return None
+    return CommitGraph(graph_path)
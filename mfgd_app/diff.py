@@ -0,0 +1,714 @@
+import bisect
+import collections
+import re
+import threading
+import time
+
+from django.conf import settings
+
+from mfgd_app import odb
+
+# Lines occurring more often than this are never used to anchor a histogram
+# diff, like git's
+MAX_CHAIN_LENGTH = 64
+# Regions larger than this, in lines on both sides, are first split around
+# the lines occurring once on each side, so each histogram pass only indexes
+# a small region
+UNIQUE_ANCHOR_LINES = 256
+# Regions without an anchor larger than this, in lines on both sides, are
+# shown as one replacement instead of being handed to Myers
+MAX_FALLBACK_LINES = 1000
+CONTEXT_LINES = 3
+
+# Rename and copy detection, scores are percentages like git's -M50%
+MIN_SIMILARITY = 50
+FINGERPRINT_CHUNK_RE = re.compile(rb"[^\n]{1,64}\n?|\n")
+
+
+class DiffTooLarge(Exception):
+    pass
+
+
+def split_lines(data):
+    """Split on newlines only, keeping them, like git does"""
+    lines = data.split(b"\n")
+    last = lines.pop()
+    lines = [line + b"\n" for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def intern_lines(a, b):
+    """Map each distinct line to an integer so comparing lines is cheap"""
+    ids = {line: n for n, line in enumerate(dict.fromkeys(a + b))}
+    return list(map(ids.__getitem__, a)), list(map(ids.__getitem__, b))
+
+
+def check_deadline(deadline):
+    if deadline is not None and time.monotonic() > deadline:
+        raise DiffTooLarge
+
+
+def myers(a, b, alo, ahi, blo, bhi, blocks, deadline):
+    """Append the matching blocks of a shortest edit script for the region"""
+    n = ahi - alo
+    m = bhi - blo
+    offset = n + m + 1
+    v = [0] * (2 * offset + 1)
+    trace = []
+    for d in range(n + m + 1):
+        check_deadline(deadline)
+        trace.append(v[offset - d : offset + d + 1])
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                break
+        else:
+            continue
+        break
+
+    # Walk the trace back from the end to recover the diagonals taken
+    x, y = n, m
+    found = []
+    for d in range(len(trace) - 1, 0, -1):
+        prev = trace[d]
+        k = x - y
+        if k == -d or (k != d and prev[k - 1 + d] < prev[k + 1 + d]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = prev[prev_k + d]
+        prev_y = prev_x - prev_k
+        start_x = prev_x + 1 if prev_k == k - 1 else prev_x
+        start_y = start_x - k
+        if x > start_x:
+            found.append((alo + start_x, blo + start_y, x - start_x))
+        x, y = prev_x, prev_y
+    if x > 0:
+        found.append((alo, blo, x))
+    blocks.extend(reversed(found))
+
+
+def unique_anchors(a, b, alo, ahi, blo, bhi):
+    """(i, j) of lines occurring once on each side of a region, in order
+
+    Of those lines, the longest chain that is increasing on both sides is
+    kept, as in a patience diff.
+    """
+    counts_a = collections.Counter(a[alo:ahi])
+    counts_b = collections.Counter(b[blo:bhi])
+    # Only consulted for lines occurring once, where the index is exact
+    index_a = dict(zip(a[alo:ahi], range(alo, ahi)))
+    pairs = [
+        (index_a[line], j)
+        for j, line in enumerate(b[blo:bhi], blo)
+        if counts_b[line] == 1 and counts_a.get(line) == 1
+    ]
+
+    # Longest increasing subsequence of the a indices, pairs are ordered by j
+    tails = []
+    tail_pairs = []
+    back = []
+    for pair in pairs:
+        k = bisect.bisect_left(tails, pair[0])
+        back.append(tail_pairs[k - 1] if k else None)
+        if k == len(tails):
+            tails.append(pair[0])
+            tail_pairs.append(len(back) - 1)
+        else:
+            tails[k] = pair[0]
+            tail_pairs[k] = len(back) - 1
+    chain = []
+    k = tail_pairs[-1] if tail_pairs else None
+    while k is not None:
+        chain.append(pairs[k])
+        k = back[k]
+    chain.reverse()
+    return chain
+
+
+def histogram(a, b, alo, ahi, blo, bhi, blocks, deadline):
+    """Append the matching blocks of a histogram diff of the region
+
+    The region is split around the longest run of lines anchored on the line
+    that occurs least often, and both sides are diffed again. Large regions
+    are first split around their unique lines, which is where a histogram
+    diff would anchor them too, so the occurrence index is only built for
+    small regions. Regions with no line in common are one replacement, as
+    in git. Regions whose common lines are all too frequent to anchor on fall
+    back to Myers while small, and are one replacement otherwise.
+    """
+    stack = [(alo, ahi, blo, bhi)]
+    while stack:
+        check_deadline(deadline)
+        alo, ahi, blo, bhi = stack.pop()
+
+        # Common prefix and suffix match trivially
+        start = 0
+        while alo + start < ahi and blo + start < bhi and a[alo + start] == b[blo + start]:
+            start += 1
+        if start:
+            blocks.append((alo, blo, start))
+            alo += start
+            blo += start
+        end = 0
+        while ahi - end > alo and bhi - end > blo and a[ahi - end - 1] == b[bhi - end - 1]:
+            end += 1
+        if end:
+            blocks.append((ahi - end, bhi - end, end))
+            ahi -= end
+            bhi -= end
+        if alo == ahi or blo == bhi:
+            continue
+
+        if (ahi - alo) + (bhi - blo) > UNIQUE_ANCHOR_LINES:
+            anchors = unique_anchors(a, b, alo, ahi, blo, bhi)
+            if anchors:
+                i, j = alo, blo
+                run = None
+                for ai, bj in anchors:
+                    if run is not None and ai == i and bj == j:
+                        # Adjacent anchors grow one run instead of leaving an empty gap
+                        run[2] += 1
+                    else:
+                        if run is not None:
+                            blocks.append(tuple(run))
+                        stack.append((i, ai, j, bj))
+                        run = [ai, bj, 1]
+                    i, j = ai + 1, bj + 1
+                blocks.append(tuple(run))
+                stack.append((i, ahi, j, bhi))
+                continue
+
+        occurrences = {}
+        for i in range(alo, ahi):
+            occurrences.setdefault(a[i], []).append(i)
+
+        best = None
+        best_count = MAX_CHAIN_LENGTH + 1
+        common = False
+        j = blo
+        while j < bhi:
+            positions = occurrences.get(b[j])
+            if positions is not None:
+                common = True
+            if positions is None or len(positions) > best_count:
+                j += 1
+                continue
+            next_j = j + 1
+            for i in positions:
+                si, sj = i, j
+                while si > alo and sj > blo and a[si - 1] == b[sj - 1]:
+                    si -= 1
+                    sj -= 1
+                ei, ej = i + 1, j + 1
+                while ei < ahi and ej < bhi and a[ei] == b[ej]:
+                    ei += 1
+                    ej += 1
+                count = min(len(occurrences[a[k]]) for k in range(si, ei))
+                size = ei - si
+                if best is None or count < best_count or (count == best_count and size > best[2]):
+                    best = (si, sj, size)
+                    best_count = count
+                next_j = max(next_j, ej)
+            j = next_j
+
+        if best is None:
+            if common and (ahi - alo) + (bhi - blo) <= MAX_FALLBACK_LINES:
+                myers(a, b, alo, ahi, blo, bhi, blocks, deadline)
+            continue
+        si, sj, size = best
+        blocks.append(best)
+        stack.append((alo, si, blo, sj))
+        stack.append((si + size, ahi, sj + size, bhi))
+
+
+ALGORITHMS = {
+    "myers": myers,
+    "histogram": histogram,
+}
+
+
+def matching_blocks(a, b, algorithm=None, deadline=None):
+    """Sorted, merged (i, j, size) runs of equal lines between a and b"""
+    algorithm = ALGORITHMS[algorithm or settings.DIFF_ALGORITHM]
+    a, b = intern_lines(a, b)
+    blocks = []
+    algorithm(a, b, 0, len(a), 0, len(b), blocks, deadline)
+    blocks.sort()
+
+    merged = []
+    for i, j, size in blocks:
+        if not size:
+            continue
+        if merged and merged[-1][0] + merged[-1][2] == i and merged[-1][1] + merged[-1][2] == j:
+            merged[-1] = (merged[-1][0], merged[-1][1], merged[-1][2] + size)
+        else:
+            merged.append((i, j, size))
+    return merged
+
+
+def opcodes(blocks, la, lb):
+    """Turn matching blocks into difflib style opcodes"""
+    i = j = 0
+    codes = []
+    for ai, bj, size in blocks + [(la, lb, 0)]:
+        if i < ai and j < bj:
+            codes.append(("replace", i, ai, j, bj))
+        elif i < ai:
+            codes.append(("delete", i, ai, j, bj))
+        elif j < bj:
+            codes.append(("insert", i, ai, j, bj))
+        i, j = ai + size, bj + size
+        if size:
+            codes.append(("equal", ai, i, bj, j))
+    return codes
+
+
+def grouped_opcodes(codes, n=CONTEXT_LINES):
+    """Split opcodes into hunks with n lines of context, as difflib does"""
+    if not codes:
+        codes = [("equal", 0, 1, 0, 1)]
+    if codes[0][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == "equal" and i2 - i1 > 2 * n:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        yield group
+
+
+def format_range(start, stop):
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return f"{beginning}"
+    if not length:
+        beginning -= 1
+    return f"{beginning},{length}"
+
+
+def format_line(prefix, line):
+    text = prefix + line.decode(errors="replace")
+    if not text.endswith("\n"):
+        text += "\n\\ No newline at end of file\n"
+    return text
+
+
+def count_changes(codes):
+    insertions = deletions = 0
+    for tag, i1, i2, j1, j2 in codes:
+        if tag != "equal":
+            deletions += i2 - i1
+            insertions += j2 - j1
+    return insertions, deletions
+
+
+def diff_stats(a, b, algorithm=None, deadline=None):
+    """Number of inserted and deleted lines, without formatting a patch"""
+    return count_changes(opcodes(matching_blocks(a, b, algorithm, deadline), len(a), len(b)))
+
+
+def unified_diff(a, b, fromfile, tofile, algorithm=None, deadline=None):
+    """Unified diff of two lists of byte lines, in difflib's format
+
+    Returns the patch along with the number of inserted and deleted lines.
+    """
+    codes = opcodes(matching_blocks(a, b, algorithm, deadline), len(a), len(b))
+    insertions, deletions = count_changes(codes)
+
+    out = []
+    for group in grouped_opcodes(codes):
+        if not out:
+            out.append(f"--- {fromfile}\n")
+            out.append(f"+++ {tofile}\n")
+        first, last = group[0], group[-1]
+        out.append(
+            "@@ -{} +{} @@\n".format(
+                format_range(first[1], last[2]), format_range(first[3], last[4])
+            )
+        )
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                out.extend(format_line(" ", line) for line in a[i1:i2])
+                continue
+            if tag in ("replace", "delete"):
+                out.extend(format_line("-", line) for line in a[i1:i2])
+            if tag in ("replace", "insert"):
+                out.extend(format_line("+", line) for line in b[j1:j2])
+    return "".join(out), insertions, deletions
+
+
+class FileDiff:
+    """The change to one file between two commits
+
+    patch is None when no patch was asked for or could be produced, note
+    then says why if it could not. insertions and deletions are None when
+    they were not computed. Renamed and copied files have an old_path and the similarity percentage
+    they were detected with. timed_out is set when a deadline rather than the
+    file itself kept the diff or its counts from being made.
+    """
+
+    def __init__(
+        self,
+        path,
+        status,
+        patch=None,
+        note=None,
+        insertions=0,
+        deletions=0,
+        old_path=None,
+        similarity=None,
+        timed_out=False,
+    ):
+        self.path = path
+        self.old_path = old_path
+        self.similarity = similarity
+        self.status = status
+        self.patch = patch
+        self.note = note
+        self.insertions = insertions
+        self.deletions = deletions
+        self.timed_out = timed_out
+
+
+def read_side(db, entry):
+    if entry is None:
+        return b""
+    mode, oid = entry
+    if mode == "160000":
+        return f"Subproject commit {oid}\n".encode()
+    return db.read(oid)[1]
+
+
+def diff_file(db, change, patch=True):
+    """Diff one entry of changed_files, or only count its lines if not patch"""
+    path, old_path, old, new, status, similarity = change
+
+    def result(**kwargs):
+        return FileDiff(path, status, old_path=old_path, similarity=similarity, **kwargs)
+
+    # Both sides are size checked from headers before anything is inflated
+    for entry in (old, new):
+        if entry is not None and entry[0] != "160000":
+            _, size = db.info(entry[1])
+            if size > settings.DIFF_MAX_FILE_BYTES:
+                return result(note="File too large to diff", insertions=None, deletions=None)
+
+    a = read_side(db, old)
+    b = read_side(db, new)
+    if b"\0" in a[: odb.FIRST_FEW_BYTES] or b"\0" in b[: odb.FIRST_FEW_BYTES]:
+        return result(note="Binary files differ", insertions=None, deletions=None)
+
+    deadline = time.monotonic() + settings.DIFF_MAX_FILE_SECONDS
+    try:
+        if not patch:
+            insertions, deletions = diff_stats(split_lines(a), split_lines(b), deadline=deadline)
+            return result(insertions=insertions, deletions=deletions)
+        fromfile = f"a/{old_path or path}" if old is not None else "/dev/null"
+        tofile = f"b/{path}" if new is not None else "/dev/null"
+        text, insertions, deletions = unified_diff(
+            split_lines(a), split_lines(b), fromfile, tofile, deadline=deadline
+        )
+    except DiffTooLarge:
+        return result(
+            note="File too large to diff", insertions=None, deletions=None, timed_out=True
+        )
+    return result(patch=text, insertions=insertions, deletions=deletions)
+
+
+def diff_trees(db, old_tree, new_tree, prefix="", changes=None, deadline=None):
+    """Collect (path, old, new) for every file that differs between two trees
+
+    Either tree may be None. Subtrees with the same oid on both sides are
+    identical and are skipped without being read. Raises DiffTooLarge once
+    the deadline passes, changes then holds what was found so far.
+    """
+    if changes is None:
+        changes = []
+    if old_tree == new_tree:
+        return changes
+    check_deadline(deadline)
+    old = read_tree(db, old_tree)
+    new = read_tree(db, new_tree)
+
+    for name in sorted(old.keys() | new.keys()):
+        old_entry = old.get(name)
+        new_entry = new.get(name)
+        if old_entry == new_entry:
+            continue
+        path = prefix + name
+        old_dir = old_entry is not None and old_entry[0] == "40000"
+        new_dir = new_entry is not None and new_entry[0] == "40000"
+        if old_dir or new_dir:
+            diff_trees(
+                db,
+                old_entry[1] if old_dir else None,
+                new_entry[1] if new_dir else None,
+                path + "/",
+                changes,
+                deadline,
+            )
+            # A file replaced by a directory or the other way around
+            old_entry = None if old_dir else old_entry
+            new_entry = None if new_dir else new_entry
+            if old_entry is None and new_entry is None:
+                continue
+        if old_entry is not None and new_entry is not None and old_entry[1] == new_entry[1]:
+            # Only the mode changed
+            continue
+        changes.append((path, old_entry, new_entry))
+    return changes
+
+
+def read_tree(db, tree_oid):
+    """Map the names in a tree to their (mode, oid)"""
+    if tree_oid is None:
+        return {}
+    return {name: (mode, oid) for mode, name, oid in odb.parse_tree(db.read(tree_oid)[1])}
+
+
+def fingerprint(data):
+    """Bytes per distinct chunk, chunks end at a newline or after 64 bytes"""
+    counts = collections.Counter()
+    for chunk in FINGERPRINT_CHUNK_RE.findall(data):
+        counts[hash(chunk)] += len(chunk)
+    return counts
+
+
+def similarity(src, src_size, dst, dst_size):
+    """Percentage of content shared by two fingerprinted files"""
+    if len(dst) < len(src):
+        src, dst = dst, src
+    shared = sum(min(size, dst.get(chunk, 0)) for chunk, size in src.items())
+    return shared * 100 // max(src_size, dst_size, 1)
+
+
+def is_regular(entry):
+    return entry is not None and entry[0] != "160000"
+
+
+def find_renames(db, changes, deadline=None):
+    """Pair added files with the deleted or modified files they came from
+
+    Takes (path, old, new) changes and returns (path, old_path, old, new,
+    status, similarity) ones, and whether the deadline left them complete.
+    Identical blobs pair up first. The remaining
+    added files are compared with the candidate sources by fingerprint,
+    unless there are more than DIFF_RENAME_CANDIDATES pairs to score or the
+    deadline passes while scoring them. A deleted source is renamed once,
+    further pairings with it and any pairings with modified files are copies.
+    """
+    added = [change for change in changes if change[1] is None and is_regular(change[2])]
+    deleted = [change for change in changes if change[2] is None and is_regular(change[1])]
+    modified = [change for change in changes if change[1] is not None and change[2] is not None]
+    sources = [(path, old, True) for path, old, _ in deleted]
+    sources += [(path, old, False) for path, old, _ in modified if is_regular(old)]
+
+    pairs = {}
+    timed_out = False
+    by_oid = {}
+    for source in sources:
+        by_oid.setdefault(source[1][1], source)
+    remaining = []
+    for path, _, new in added:
+        source = by_oid.get(new[1])
+        if source is not None:
+            pairs[path] = (source, 100)
+        else:
+            remaining.append((path, new))
+
+    if remaining and len(remaining) * len(sources) <= settings.DIFF_RENAME_CANDIDATES:
+        limit = settings.DIFF_MAX_FILE_BYTES
+        sizes = {}
+        for _, entry, _ in sources:
+            sizes[entry[1]] = db.info(entry[1])[1]
+        for _, entry in remaining:
+            sizes[entry[1]] = db.info(entry[1])[1]
+        fingerprints = {}
+
+        def fingerprint_of(oid):
+            if oid not in fingerprints:
+                fingerprints[oid] = fingerprint(db.read(oid)[1])
+            return fingerprints[oid]
+
+        scored = []
+        for path, new in remaining:
+            dst_size = sizes[new[1]]
+            if dst_size > limit:
+                continue
+            for source in sources:
+                if deadline is not None and time.monotonic() > deadline:
+                    timed_out = True
+                    break
+                src_size = sizes[source[1][1]]
+                if src_size > limit:
+                    continue
+                # Files this different in size cannot reach the threshold
+                if min(src_size, dst_size) * 100 < max(src_size, dst_size) * MIN_SIMILARITY:
+                    continue
+                score = similarity(
+                    fingerprint_of(source[1][1]), src_size, fingerprint_of(new[1]), dst_size
+                )
+                if score >= MIN_SIMILARITY:
+                    # Best scores first, renames before copies on a tie
+                    scored.append((-score, not source[2], source[0], path, source))
+            if timed_out:
+                # Out of time, keep only the identical blobs paired above
+                scored = []
+                break
+        scored.sort(key=lambda item: item[:4])
+        for score, _, _, path, source in scored:
+            if path not in pairs:
+                pairs[path] = (source, -score)
+
+    renamed = set()
+    results = []
+    for path, old, new in changes:
+        if path not in pairs:
+            results.append((path, None, old, new, None, None))
+            continue
+        (old_path, old, is_deleted), score = pairs[path]
+        status = "C"
+        if is_deleted and old_path not in renamed:
+            renamed.add(old_path)
+            status = "R"
+        results.append((path, old_path, old, new, status, score))
+    results = [
+        result
+        for result in results
+        if not (result[4] is None and result[3] is None and result[0] in renamed)
+    ]
+    return results, not timed_out
+
+
+class ChangesCache:
+    """LRU of the files changed by recently viewed commits
+
+    The change list of a commit against a parent never changes, so the
+    per-file diff requests of a commit page share one tree comparison and
+    rename detection pass.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            changes = self.entries.get(key)
+            if changes is not None:
+                self.entries.move_to_end(key)
+            return changes
+
+    def put(self, key, changes):
+        with self.lock:
+            self.entries[key] = changes
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+_changes_cache = ChangesCache(settings.DIFF_CHANGES_CACHE_SIZE)
+
+
+def changed_files(repo, parent, commit, deadline=None):
+    """(path, old_path, old, new, status, similarity) for each changed file
+
+    parent may be None for a root commit. Entries are sorted by path. Comes
+    with whether the list is complete: comparing the trees stops at the
+    deadline, and content based rename detection gets DIFF_RENAME_SECONDS or
+    until the deadline if that comes first. Only fully listed changes are
+    cached.
+    """
+    old_tree = parent.tree if parent is not None else None
+    key = (repo.path, old_tree, commit.tree)
+    cached = _changes_cache.get(key)
+    if cached is not None:
+        return cached
+
+    db = repo.odb
+    tree_changes = []
+    listed = True
+    try:
+        diff_trees(db, old_tree, commit.tree, changes=tree_changes, deadline=deadline)
+    except DiffTooLarge:
+        listed = False
+    rename_deadline = time.monotonic() + settings.DIFF_RENAME_SECONDS
+    if deadline is not None:
+        rename_deadline = min(rename_deadline, deadline)
+    found, renamed = find_renames(db, sorted(tree_changes), rename_deadline)
+
+    changes = []
+    for path, old_path, old, new, status, score in found:
+        if status is None:
+            if old is None:
+                status = "A"
+            elif new is None:
+                status = "D"
+            else:
+                status = "M"
+        changes.append((path, old_path, old, new, status, score))
+    # Per-file diff requests look files up here, so a cut short list is not kept
+    if listed:
+        _changes_cache.put(key, (changes, renamed))
+    return changes, listed and renamed
+
+
+def diff_commits(repo, parent, commit, patches=True, budget=None):
+    """Diff every file changed between parent, which may be None, and commit
+
+    Without patches only line counts are computed. The budget in seconds
+    covers comparing the trees, rename detection and line counting. Once it
+    is spent the remaining files are listed without counts, or not at all if
+    the trees were not fully compared. Comes with whether nothing was cut
+    short by a deadline.
+    """
+    deadline = time.monotonic() + budget if budget is not None else None
+    changes, complete = changed_files(repo, parent, commit, deadline)
+    diffs = []
+    for change in changes:
+        if deadline is not None and time.monotonic() > deadline:
+            path, old_path, _, _, status, score = change
+            diffs.append(
+                FileDiff(
+                    path,
+                    status,
+                    insertions=None,
+                    deletions=None,
+                    old_path=old_path,
+                    similarity=score,
+                    timed_out=True,
+                )
+            )
+        else:
+            diffs.append(diff_file(repo.odb, change, patches))
+    return diffs, complete and not any(result.timed_out for result in diffs)
+
+
+def diff_path(repo, parent, commit, path):
+    """Diff the single file at path in commit, None if it did not change"""
+    for change in changed_files(repo, parent, commit)[0]:
+        if change[0] == path:
+            return diff_file(repo.odb, change)
+    return None
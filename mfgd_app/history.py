@@ -0,0 +1,168 @@
+import collections
+import heapq
+import itertools
+import threading
+
+from django.conf import settings
+
+from mfgd_app import odb
+
+
+def get_latest_changes(repo, oid, parts, names, index=None):
+    """Find the latest commit changing each of names inside directory parts
+
+    This follows git's history simplification: while a commit leaves an entry
+    identical to one of its parents, the search for that entry continues down
+    the first such parent only. The first commit where the entry differs from
+    every parent is the one that last changed it. All names share one walk in
+    committer date order, which stops once every name is accounted for.
+
+    With an index, answers recorded for any commit reached by the walk are
+    reused, so moving a branch head only costs walking the new commits.
+
+    The walk reads raw objects straight from the object database and only the
+    resulting commits are loaded through the repository.
+    """
+    db = repo.odb
+    commits = {}
+    dir_oids = {}
+    trees = {}
+
+    def tree(tree_oid):
+        if tree_oid is None:
+            return {}
+        if tree_oid not in trees:
+            type, data = db.read(tree_oid)
+            trees[tree_oid] = {}
+            if type == "tree":
+                trees[tree_oid] = {name: oid for _, name, oid in odb.parse_tree(data)}
+        return trees[tree_oid]
+
+    def load(commit_oid):
+        if commit_oid not in commits:
+            commit = db.commit_header(commit_oid)
+            tree_oid = commit.tree
+            for part in parts:
+                tree_oid = tree(tree_oid).get(part)
+            commits[commit_oid] = commit
+            dir_oids[commit_oid] = tree_oid
+        return commits[commit_oid]
+
+    def listing(commit_oid):
+        return tree(dir_oids[commit_oid])
+
+    routes = {}
+    frontier = []
+
+    def route(commit_oid, route_names):
+        if commit_oid not in routes:
+            commit = load(commit_oid)
+            routes[commit_oid] = set()
+            heapq.heappush(frontier, (-commit.timestamp, commit_oid))
+        routes[commit_oid].update(route_names)
+
+    changes = {}
+    route(oid, names)
+    while frontier:
+        _, commit_oid = heapq.heappop(frontier)
+        commit = commits[commit_oid]
+        route_names = routes.pop(commit_oid)
+        if index is not None:
+            for name, change_oid in index.lookup(commit_oid, parts, route_names).items():
+                changes[name] = change_oid
+                route_names.discard(name)
+            if not route_names:
+                continue
+        for parent in commit.parents:
+            load(parent)
+
+        # Nothing below the directory changed relative to the first parent
+        if commit.parents and dir_oids[commit.parents[0]] == dir_oids[commit_oid]:
+            route(commit.parents[0], route_names)
+            continue
+
+        entries = listing(commit_oid)
+        for name in route_names:
+            entry_oid = entries.get(name)
+            for parent in commit.parents:
+                if listing(parent).get(name) == entry_oid:
+                    route(parent, (name,))
+                    break
+            else:
+                changes[name] = commit_oid
+
+    if index is not None:
+        index.store(oid, parts, changes)
+    return {name: repo[change_oid] for name, change_oid in changes.items()}
+
+
+def get_latest_change(repo, oid, parts, index=None):
+    """Find the latest commit changing the entry at parts"""
+    *parent, name = parts
+    return get_latest_changes(repo, oid, parent, (name,), index).get(name)
+
+
+class Walk:
+    """Commits reachable from a tip, newest committer date first
+
+    The frontier survives between pages, so a paused walk carries on from
+    where it stopped instead of starting over from the tip.
+    """
+
+    def __init__(self, db, oid):
+        self.db = db
+        self.frontier = []
+        self.seen = set()
+        # Commits with equal dates come out in the order they were queued
+        self.order = itertools.count()
+        self.push(oid)
+
+    def push(self, oid):
+        if oid not in self.seen:
+            self.seen.add(oid)
+            commit = self.db.commit_header(oid)
+            heapq.heappush(self.frontier, (-commit.timestamp, next(self.order), commit))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.frontier:
+            raise StopIteration
+        _, _, commit = heapq.heappop(self.frontier)
+        for parent in commit.parents:
+            self.push(parent)
+        return commit
+
+
+_walks_lock = threading.Lock()
+_walks = collections.OrderedDict()
+
+
+def resume_walk(repo, oid, after=None):
+    """Walk from oid, continuing after the commit after if given
+
+    Walks paused by save_walk are picked up where they stopped, otherwise the
+    history is walked from the tip up to after.
+    """
+    if after is None:
+        return Walk(repo.odb, oid)
+
+    with _walks_lock:
+        walk = _walks.pop((repo.path, oid, after), None)
+    if walk is not None:
+        return walk
+
+    walk = Walk(repo.odb, oid)
+    for commit in walk:
+        if commit.oid == after:
+            break
+    return walk
+
+
+def save_walk(repo, oid, after, walk):
+    """Pause a walk so resume_walk(repo, oid, after) can continue it"""
+    with _walks_lock:
+        _walks[(repo.path, oid, after)] = walk
+        while len(_walks) > settings.PAUSED_WALKS:
+            _walks.popitem(last=False)
@@ -0,0 +1,137 @@
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+
+from django.conf import settings
+
+
+class HighlightCache:
+    """Two-tier cache of highlighted HTML keyed by what determines it
+
+    An in-process LRU sits in front of a directory shared by all workers.
+    Both tiers are bounded in bytes. The disk tier drops its least recently
+    used files once it outgrows its budget.
+    """
+
+    def __init__(self, directory, memory_budget, disk_budget):
+        self.directory = directory
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.resident = 0
+        # Estimate of the disk tier's size, refreshed whenever it is trimmed
+        self.disk_usage = None
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest[2:] + ".html")
+
+    def get_or_render(self, key, render):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        with self.lock:
+            html = self.entries.get(digest)
+            if html is not None:
+                self.entries.move_to_end(digest)
+                return html
+
+        html = self.load(digest)
+        if html is None:
+            html = render()
+            self.store(digest, html)
+        self.remember(digest, html)
+        return html
+
+    def remember(self, digest, html):
+        size = len(html)
+        if size > self.memory_budget:
+            return
+        with self.lock:
+            if digest in self.entries:
+                return
+            self.entries[digest] = html
+            self.resident += size
+            while self.resident > self.memory_budget:
+                _, evicted = self.entries.popitem(last=False)
+                self.resident -= len(evicted)
+
+    def load(self, digest):
+        path = self.path(digest)
+        try:
+            with open(path, encoding="utf-8") as f:
+                html = f.read()
+            # Mark as recently used for eviction
+            os.utime(path)
+        except (OSError, UnicodeDecodeError):
+            # The disk tier is only a cache, anything unreadable is a miss
+            return None
+        return html
+
+    def store(self, digest, html):
+        path = self.path(digest)
+        data = html.encode()
+        if len(data) > self.disk_budget:
+            return
+        tmp_path = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            # A full or read-only cache directory just means a miss later
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            return
+
+        with self.lock:
+            if self.disk_usage is not None:
+                self.disk_usage += len(data)
+            trim = self.disk_usage is None or self.disk_usage > self.disk_budget
+        if trim:
+            self.trim()
+
+    def trim(self):
+        """Remove least recently used files until the disk tier fits its budget"""
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        usage = sum(size for _, size, _ in files)
+        files.sort()
+        for _, size, path in files:
+            if usage <= self.disk_budget:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            usage -= size
+
+        with self.lock:
+            self.disk_usage = usage
+
+
+_cache = HighlightCache(
+    settings.HIGHLIGHT_CACHE_DIR,
+    settings.HIGHLIGHT_CACHE_MEMORY_BYTES,
+    settings.HIGHLIGHT_CACHE_DISK_BYTES,
+)
+
+
+def get_or_render(key, render):
+    """Return the cached HTML for key, calling render() to produce it on a miss"""
+    return _cache.get_or_render(key, render)
@@ -0,0 +1,166 @@
+import functools
+import hashlib
+
+from django.conf import settings
+from django.http import HttpResponseNotModified
+from django.template.loader import render_to_string
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags
+
+from mfgd_app import odb, pagecache, refs
+from mfgd_app.models import Repository
+from mfgd_app.utils import Permission, normalize_path
+
+
+# Stand in for the parts of a cached page that differ between requests
+GREETING_MARKER = "<!-- greeting -->"
+REF_MARKER = "<!-- ref -->"
+
+
+def make_etag(*parts):
+    return '"{}"'.format(hashlib.sha1(repr(parts).encode()).hexdigest())
+
+
+def commit_validator(repo_name, oid):
+    """(commit oid, immutable) a URL's oid stands for, None if unknown
+
+    A full oid always names the same commit. A branch or tag name stands for
+    whatever it points to right now, read from the ref files without opening
+    the repository.
+    """
+    if odb.oid_re.fullmatch(oid):
+        return oid, True
+    try:
+        repo = Repository.objects.get(name=repo_name)
+    except Repository.DoesNotExist:
+        return None
+    target = refs.resolve(repo.path, oid)
+    if target is None:
+        return None
+    return target, False
+
+
+def mark_incomplete(response):
+    """Flag a response whose content was cut short by a time budget
+
+    Such a page may come out differently on the next request, so it is
+    neither given an ETag nor cached for long.
+    """
+    response.incomplete = True
+
+
+def fill_in_context(request):
+    """Template context putting markers where per-request parts go
+
+    Empty unless the page is rendered for the page cache.
+    """
+    if not getattr(request, "fill_in", False):
+        return {}
+    return {"greeting_marker": GREETING_MARKER, "ref_marker": REF_MARKER}
+
+
+def fill_in(response, parts):
+    """Replace the markers in a page with their rendered parts"""
+    parts = [(marker.encode(), html.encode()) for marker, html in parts.items()]
+
+    def replace(content):
+        for marker, html in parts:
+            content = content.replace(marker, html)
+        return content
+
+    # Parts are rendered whole, so a marker never spans chunks
+    if response.streaming:
+        response.streaming_content = map(replace, response.streaming_content)
+    else:
+        response.content = replace(response.content)
+
+
+def conditional_on_commit(kind, params=(), html=False, fill=None):
+    """Add ETag and Cache-Control headers to a view rendering a commit
+
+    The ETag covers everything the page depends on: the commit and how the
+    URL named it, the path and query, the permission it was rendered with
+    and the user it greets. A matching If-None-Match is answered with 304
+    before the view runs.
+
+    Otherwise the page is looked up in the page cache, keyed only by the
+    commit the URL resolves to, the path, the query parameters in params and
+    the permission, so branch names and full oids as well as different users
+    share entries. For html pages the greeting, and whatever fill renders
+    from the view's arguments, are left out of the cached page as markers
+    and filled in for every request.
+
+    Pages for full oids are cached for a long time, pages for branch names
+    only briefly since the branch may move. Responses flagged by
+    mark_incomplete are only cached briefly. Goes below
+    verify_user_permissions.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def _inner(request, permission, repo_name, oid, *args, **kwargs):
+            if permission == Permission.NO_ACCESS or request.method not in ("GET", "HEAD"):
+                return view(request, permission, repo_name, oid, *args, **kwargs)
+            validator = commit_validator(repo_name, oid)
+            if validator is None:
+                return view(request, permission, repo_name, oid, *args, **kwargs)
+
+            target, immutable = validator
+            etag = make_etag(
+                kind,
+                repo_name,
+                oid,
+                target,
+                normalize_path(kwargs.get("path", "")),
+                sorted(request.GET.items()),
+                int(permission),
+                request.user.pk,
+            )
+            if_none_match = parse_etags(request.headers.get("If-None-Match", ""))
+            if etag in if_none_match or "*" in if_none_match:
+                response = HttpResponseNotModified()
+            else:
+                page_key = "page:" + make_etag(
+                    kind,
+                    repo_name,
+                    target,
+                    normalize_path(kwargs.get("path", "")),
+                    [request.GET.get(name) for name in params],
+                    int(permission),
+                ).strip('"')
+                # Only whole pages are cached, range requests always run the view
+                cacheable = "Range" not in request.headers
+                response = pagecache.load(page_key) if cacheable else None
+                if response is None:
+                    request.fill_in = html
+                    response = view(request, permission, repo_name, oid, *args, **kwargs)
+                    if response.status_code not in (200, 206):
+                        return response
+                    if cacheable and not getattr(response, "incomplete", False):
+                        pagecache.store(page_key, response)
+                if html:
+                    parts = {GREETING_MARKER: render_to_string("greeting.html", request=request)}
+                    if fill is not None:
+                        parts.update(fill(request, repo_name, oid, *args, **kwargs))
+                    fill_in(response, parts)
+
+            if getattr(response, "incomplete", False):
+                # The next render may differ, so nothing may revalidate against it
+                max_age = settings.INCOMPLETE_PAGE_MAX_AGE
+                immutable = False
+            else:
+                response["ETag"] = etag
+                max_age = settings.COMMIT_PAGE_MAX_AGE if immutable else settings.BRANCH_PAGE_MAX_AGE
+            # Shared caches may only keep what any anonymous visitor would get
+            if request.user.is_anonymous:
+                patch_cache_control(response, max_age=max_age, public=True)
+            else:
+                patch_cache_control(response, max_age=max_age, private=True)
+            if immutable:
+                patch_cache_control(response, immutable=True)
+            patch_vary_headers(response, ("Cookie",))
+            return response
+
+        return _inner
+
+    return decorator
@@ -0,0 +1,80 @@
+import collections
+import fnmatch
+import functools
+import posixpath
+import re
+
+from pygments.lexers import find_lexer_class, find_lexer_class_for_filename, get_all_lexers
+
+# Characters that make a filename pattern more than a plain name or extension
+GLOB_CHARS = set("*?[")
+
+
+class LexerTable:
+    """Filename to lexer resolution built once from pygments' registry
+
+    Patterns that are exact filenames or plain "*.ext" extensions are indexed
+    in dictionaries. Any filename that one of the remaining glob patterns
+    could match goes through pygments' full registry scan instead, memoized
+    per filename. Either way the pick matches get_lexer_for_filename.
+    """
+
+    def __init__(self):
+        self.exact = collections.defaultdict(list)
+        self.extensions = collections.defaultdict(list)
+        globs = []
+        for name, _, patterns, _ in get_all_lexers():
+            for pattern in patterns:
+                if not GLOB_CHARS.intersection(pattern):
+                    self.exact[pattern].append((name, pattern))
+                elif pattern.startswith("*.") and not GLOB_CHARS.intersection(pattern[1:]):
+                    self.extensions[pattern[1:]].append((name, pattern))
+                else:
+                    globs.append(fnmatch.translate(pattern))
+        self.globs_re = re.compile("|".join(globs)) if globs else None
+
+    def candidates(self, filename):
+        yield from self.exact.get(filename, ())
+        dot = filename.find(".")
+        while dot >= 0:
+            yield from self.extensions.get(filename[dot:], ())
+            dot = filename.find(".", dot + 1)
+
+    def resolve(self, filename):
+        if self.globs_re is not None and self.globs_re.match(filename):
+            return find_lexer_class_for_filename(filename)
+
+        def rating(candidate):
+            cls, pattern = candidate
+            # Same ordering as pygments: explicit names beat extensions
+            bonus = 0.5 if "*" not in pattern else 0
+            return cls.priority + bonus, cls.__name__
+
+        matches = [(find_lexer_class(name), pattern) for name, pattern in self.candidates(filename)]
+        if not matches:
+            return None
+        return max(matches, key=rating)[0]
+
+
+_table = LexerTable()
+
+
+@functools.lru_cache(maxsize=4096)
+def lexer_class_for_filename(filename):
+    """Lexer class for a file, falling back to plain text"""
+    return _table.resolve(posixpath.basename(filename)) or _table.resolve("name.txt")
+
+
+@functools.lru_cache(maxsize=None)
+def lexer_instance(cls):
+    return cls(stripall=True)
+
+
+def lexer_for_filename(filename):
+    """Shared lexer instance for a file, falling back to plain text"""
+    return lexer_instance(lexer_class_for_filename(filename))
+
+
+def language_for_filename(filename):
+    """Human readable name of a file's language"""
+    return lexer_class_for_filename(filename).name
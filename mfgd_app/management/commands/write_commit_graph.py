@@ -0,0 +1,27 @@
+import subprocess
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mfgd_app.models import Repository
+
+
+class Command(BaseCommand):
+    help = "Write commit-graph files so history walks skip inflating commits"
+
+    def add_arguments(self, parser):
+        parser.add_argument("repositories", nargs="*", help="defaults to all repositories")
+
+    def handle(self, *args, **options):
+        repos = Repository.objects.all()
+        if options["repositories"]:
+            repos = repos.filter(name__in=options["repositories"])
+
+        for repo in repos:
+            try:
+                subprocess.run(
+                    ["git", "-C", repo.path, "commit-graph", "write", "--reachable"],
+                    check=True,
+                )
+            except (OSError, subprocess.CalledProcessError) as e:
+                raise CommandError(f'failed to write commit-graph for "{repo.name}": {e}')
+            self.stdout.write(f'[ OK ] wrote commit-graph for "{repo.name}"')
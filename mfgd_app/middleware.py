@@ -0,0 +1,47 @@
+import logging
+
+from django.conf import settings
+
+from mfgd_app import objcache, odb, repopool
+
+logger = logging.getLogger(__name__)
+
+
+def format_stats(stats):
+    return ", ".join(
+        f"{name}={value:.2f}" if isinstance(value, float) else f"{name}={value}"
+        for name, value in stats.items()
+    )
+
+
+def log_after(request, chunks):
+    """Pass streamed chunks through, logging the request's count after the last"""
+    yield from chunks
+    logger.debug(
+        "%s %s: %d delta applications", request.method, request.path, odb.delta_applications()
+    )
+
+
+class ObjectStatsMiddleware:
+    """Count delta applications per request, reported in debug builds
+
+    Streamed pages do their reads while the body is sent, so their count is
+    logged once the last chunk went out instead of sent as a header. Debug
+    builds also report the process-wide repository pool and object cache
+    counters.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        odb.reset_counters()
+        response = self.get_response(request)
+        if settings.DEBUG:
+            if response.streaming:
+                response.streaming_content = log_after(request, response.streaming_content)
+            else:
+                response["X-Delta-Applications"] = str(odb.delta_applications())
+            response["X-Repository-Pool"] = format_stats(repopool.pool_stats())
+            response["X-Object-Cache"] = format_stats(objcache.cache_stats())
+        return response
@@ -0,0 +1,29 @@
+# Generated by Django 3.1.7 on 2026-10-18 04:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mfgd_app', '0005_userprofile_image'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RepositorySummary',
+            fields=[
+                ('repo', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summary', serialize=False, to='mfgd_app.repository')),
+                ('defaultBranch', models.CharField(blank=True, max_length=256)),
+                ('headOid', models.CharField(blank=True, max_length=40)),
+                ('lastCommitDate', models.DateTimeField(null=True)),
+                ('size', models.BigIntegerField(default=0)),
+                ('branchCount', models.IntegerField(default=0)),
+                ('statKey', models.CharField(blank=True, max_length=256)),
+            ],
+            options={
+                'verbose_name_plural': 'RepositorySummaries',
+            },
+        ),
+    ]
@@ -52,3 +52,27 @@ class CanAccess(models.Model):
 
     def __str__(self):
         return f"{self.user}:{self.repo}"
+
+
+class RepositorySummary(models.Model):
+    """What the dashboard shows about a repository, cached from disk
+
+    statKey records the state of the HEAD and ref files the summary was read
+    from, it is refreshed once they change.
+    """
+
+    repo = models.OneToOneField(
+        Repository, on_delete=models.CASCADE, primary_key=True, related_name="summary"
+    )
+    defaultBranch = models.CharField(max_length=256, blank=True)
+    headOid = models.CharField(max_length=40, blank=True)
+    lastCommitDate = models.DateTimeField(null=True)
+    size = models.BigIntegerField(default=0)
+    branchCount = models.IntegerField(default=0)
+    statKey = models.CharField(max_length=256, blank=True)
+
+    class Meta:
+        verbose_name_plural = "RepositorySummaries"
+
+    def __str__(self):
+        return f"{self.repo}:{self.headOid}"
@@ -0,0 +1,205 @@
+import collections
+import threading
+
+from django.conf import settings
+from mpygit import mpygit
+
+from mfgd_app import odb
+
+# Rough per-object bookkeeping overhead of the parsed Python objects
+OBJECT_OVERHEAD = 256
+ENTRY_OVERHEAD = 128
+
+
+def estimate_size(obj):
+    """Approximate memory held by a parsed object"""
+    if isinstance(obj, mpygit.Blob):
+        return OBJECT_OVERHEAD + obj.size
+    if isinstance(obj, mpygit.Tree):
+        return OBJECT_OVERHEAD + sum(ENTRY_OVERHEAD + len(entry.name) for entry in obj)
+    if isinstance(obj, mpygit.Commit):
+        return OBJECT_OVERHEAD + len(obj.message)
+    return OBJECT_OVERHEAD
+
+
+class ObjectCache:
+    """LRU of parsed objects bounded by their estimated size in bytes
+
+    Objects are immutable for a given oid so entries never go stale, they are
+    only evicted to stay within the budget. Blobs larger than max_blob are
+    never cached so a single large file cannot flush everything else.
+    """
+
+    def __init__(self, budget, max_blob):
+        self.budget = budget
+        self.max_blob = max_blob
+        self.lock = threading.Lock()
+        self.objects = collections.OrderedDict()
+        self.resident = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, oid):
+        with self.lock:
+            try:
+                obj, _ = self.objects[oid]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.objects.move_to_end(oid)
+            self.hits += 1
+            return obj
+
+    def put(self, oid, obj):
+        if isinstance(obj, mpygit.Blob) and obj.size > self.max_blob:
+            return
+        size = estimate_size(obj)
+        if size > self.budget:
+            return
+        with self.lock:
+            if oid in self.objects:
+                return
+            self.objects[oid] = (obj, size)
+            self.resident += size
+            while self.resident > self.budget:
+                _, (_, evicted) = self.objects.popitem(last=False)
+                self.resident -= evicted
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.objects),
+                "resident_bytes": self.resident,
+                "budget_bytes": self.budget,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class Commit(mpygit.Commit):
+    """A commit parsed from an ObjectDatabase read"""
+
+    def __init__(self, oid, data):
+        self.oid = oid
+        self.short_oid = oid[:7]
+        self.parents = []
+        header, _, message = data.partition(b"\n\n")
+        for line in header.split(b"\n"):
+            key, _, value = line.partition(b" ")
+            if key == b"tree":
+                self.tree = value.decode()
+            elif key == b"parent":
+                self.parents.append(value.decode())
+            elif key == b"author":
+                self.author = odb.Signature(value.decode(errors="replace"))
+            elif key == b"committer":
+                self.committer = odb.Signature(value.decode(errors="replace"))
+        self.message = message.decode(errors="replace")
+
+
+class TreeEntry:
+    def __init__(self, mode, name, oid):
+        self.mode = mode
+        self.name = name
+        self.oid = oid
+
+    @property
+    def type_str(self):
+        if self.isdir():
+            return "tree"
+        return "commit" if self.issubmod() else "blob"
+
+    def isdir(self):
+        return self.mode == "40000"
+
+    def issubmod(self):
+        return self.mode == "160000"
+
+
+class Tree(mpygit.Tree):
+    """A tree parsed from an ObjectDatabase read"""
+
+    def __init__(self, oid, data):
+        self.oid = oid
+        self.entries = [TreeEntry(*entry) for entry in odb.parse_tree(data)]
+        self.by_name = {entry.name: entry for entry in self.entries}
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, name):
+        return self.by_name.get(name)
+
+
+class Blob(mpygit.Blob):
+    """A blob read from an ObjectDatabase"""
+
+    def __init__(self, oid, data):
+        self.oid = oid
+        self.data = data
+        self.size = len(data)
+        self.is_binary = b"\0" in data[: odb.FIRST_FEW_BYTES]
+
+
+OBJECT_TYPES = {"commit": Commit, "tree": Tree, "blob": Blob}
+
+
+def load(db, oid):
+    """Parse the object with hex oid from an ObjectDatabase
+
+    Returns None for missing objects and False for types that are left to
+    mpygit, like annotated tags.
+    """
+    found = db.read(oid)
+    if found is None:
+        return None
+    type, data = found
+    cls = OBJECT_TYPES.get(type)
+    return cls(oid, data) if cls is not None else False
+
+
+class CachedRepository:
+    """Repository wrapper serving lookups by full oid from an object cache
+
+    Misses are read through the repository's ObjectDatabase, so pack reads
+    go through its mmaps and fan-out lookups. Anything else, like branch
+    names, goes straight to the repository since what those resolve to
+    changes over time.
+    """
+
+    def __init__(self, repo, cache):
+        self.repo = repo
+        self.cache = cache
+        self.odb = None
+
+    def __getitem__(self, key):
+        if not isinstance(key, str) or not odb.oid_re.fullmatch(key):
+            return self.repo[key]
+        obj = self.cache.get(key)
+        if obj is None:
+            obj = load(self.odb, key) if self.odb is not None else False
+            if obj is False:
+                obj = self.repo[key]
+            if obj is not None:
+                self.cache.put(key, obj)
+        return obj
+
+    def __getattr__(self, name):
+        return getattr(self.repo, name)
+
+
+_cache = ObjectCache(settings.OBJECT_CACHE_BYTES, settings.OBJECT_CACHE_MAX_BLOB)
+
+
+def wrap(repo):
+    """Put a repository behind the process-wide object cache"""
+    return CachedRepository(repo, _cache)
+
+
+def cache_stats():
+    return _cache.stats()
@@ -0,0 +1,636 @@
+import collections
+import functools
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+
+from django.conf import settings
+
+from mfgd_app import commitgraph
+
+oid_re = re.compile(r"[0-9a-f]{40}")
+
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+TYPE_NAMES = {
+    OBJ_COMMIT: "commit",
+    OBJ_TREE: "tree",
+    OBJ_BLOB: "blob",
+    OBJ_TAG: "tag",
+}
+
+# How much of a blob is checked for NUL bytes to call it binary, like git
+FIRST_FEW_BYTES = 8000
+
+# Initial amount of compressed input handed to zlib per object, beyond the
+# inflated size, before falling back to fixed size chunks
+INFLATE_SLACK = 512
+INFLATE_CHUNK = 64 << 10
+
+
+def map_file(path):
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def inflate(view, pos, size):
+    """Inflate the zlib stream of known inflated size starting at view[pos]"""
+    d = zlib.decompressobj()
+    step = size + INFLATE_SLACK
+    out = []
+    while not d.eof:
+        chunk = view[pos : pos + step]
+        if not chunk:
+            raise ValueError("truncated zlib stream")
+        out.append(d.decompress(chunk))
+        pos += step
+        step = INFLATE_CHUNK
+    return b"".join(out)
+
+
+def inflate_head(view, pos, size):
+    """Inflate only the first size bytes of the zlib stream at view[pos]"""
+    d = zlib.decompressobj()
+    return d.decompress(view[pos : pos + size + INFLATE_SLACK], size)
+
+
+def inflate_chunks(source):
+    """Lazily inflate a zlib stream given as chunks of compressed input
+
+    Output is produced at most INFLATE_CHUNK bytes at a time, so a large
+    object is never held in memory all at once.
+    """
+    d = zlib.decompressobj()
+    for chunk in source:
+        while chunk and not d.eof:
+            out = d.decompress(chunk, INFLATE_CHUNK)
+            chunk = d.unconsumed_tail
+            if out:
+                yield out
+        if d.eof:
+            return
+    raise ValueError("truncated zlib stream")
+
+
+def view_chunks(view, pos):
+    while pos < len(view):
+        yield view[pos : pos + INFLATE_CHUNK]
+        pos += INFLATE_CHUNK
+
+
+def file_chunks(path):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(INFLATE_CHUNK)
+            if not chunk:
+                return
+            yield chunk
+
+
+def window(chunks, start, end):
+    """Cut bytes [start, end) out of a stream of chunks"""
+    pos = 0
+    for chunk in chunks:
+        chunk_start = pos
+        pos += len(chunk)
+        if pos <= start:
+            continue
+        yield chunk[max(start - chunk_start, 0) : end - chunk_start]
+        if pos >= end:
+            return
+
+
+class ObjectStream:
+    """An object opened for reading its data in chunks"""
+
+    def __init__(self, type, size, source):
+        self.type = type
+        self.size = size
+        self.source = source
+
+    def chunks(self, start=0, end=None):
+        """Yield the object's data from start up to end"""
+        end = self.size if end is None else min(end, self.size)
+        if start >= end:
+            return iter(())
+        return window(self.source(), start, end)
+
+
+class PackIndex:
+    """Version 2 pack index, memory-mapped
+
+    Lookups narrow the candidates with the 256-entry fan-out table on the
+    first oid byte, then binary search the sorted oid table.
+    """
+
+    def __init__(self, path):
+        self.map = map_file(path)
+        if self.map[:4] != b"\377tOc" or struct.unpack_from(">I", self.map, 4)[0] != 2:
+            raise ValueError(f"unsupported pack index {path}")
+        self.fanout = struct.unpack_from(">256I", self.map, 8)
+        self.count = self.fanout[255]
+        self.oid_base = 8 + 256 * 4
+        self.off32_base = self.oid_base + self.count * 24
+        self.off64_base = self.off32_base + self.count * 4
+
+    def find(self, oid):
+        """Offset into the pack of the object with binary oid, or None"""
+        first = oid[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self.oid_base + mid * 20
+            cur = self.map[pos : pos + 20]
+            if cur < oid:
+                lo = mid + 1
+            elif cur > oid:
+                hi = mid
+            else:
+                return self.offset(mid)
+        return None
+
+    def offset(self, i):
+        offset = struct.unpack_from(">I", self.map, self.off32_base + i * 4)[0]
+        if offset & 0x80000000:
+            i = offset & 0x7FFFFFFF
+            offset = struct.unpack_from(">Q", self.map, self.off64_base + i * 8)[0]
+        return offset
+
+
+class Pack:
+    """Memory-mapped packfile with its index"""
+
+    def __init__(self, path):
+        self.path = path
+        self.index = PackIndex(path[:-5] + ".idx")
+        self.map = map_file(path)
+        self.view = memoryview(self.map)
+        if self.map[:4] != b"PACK":
+            raise ValueError(f"not a packfile {path}")
+
+    def header(self, offset):
+        """Parse the object header at offset
+
+        Returns (type, inflated size, data position, delta base) where the
+        base is a pack offset for OFS_DELTA and a binary oid for REF_DELTA.
+        """
+        view = self.view
+        byte = view[offset]
+        type = (byte >> 4) & 7
+        size = byte & 15
+        shift = 4
+        pos = offset + 1
+        while byte & 0x80:
+            byte = view[pos]
+            size |= (byte & 0x7F) << shift
+            shift += 7
+            pos += 1
+
+        base = None
+        if type == OBJ_OFS_DELTA:
+            byte = view[pos]
+            pos += 1
+            rel = byte & 0x7F
+            while byte & 0x80:
+                byte = view[pos]
+                pos += 1
+                rel = ((rel + 1) << 7) | (byte & 0x7F)
+            base = offset - rel
+        elif type == OBJ_REF_DELTA:
+            base = bytes(view[pos : pos + 20])
+            pos += 20
+        return type, size, pos, base
+
+
+class DeltaBaseCache:
+    """LRU of reconstructed delta bases keyed by (pack path, offset)
+
+    Packs are named after their content so an offset into a given pack
+    always holds the same object, entries never need invalidating. This plays
+    the role of git's core.deltaBaseCacheLimit.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.resident = 0
+
+    def get(self, key):
+        with self.lock:
+            try:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            except KeyError:
+                return None
+
+    def put(self, key, type, data):
+        if len(data) > self.limit:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (type, data)
+            self.resident += len(data)
+            while self.resident > self.limit:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.resident -= len(evicted)
+
+
+class InfoCache:
+    """LRU of object type, size and binary-ness keyed by oid"""
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, oid):
+        with self.lock:
+            try:
+                self.entries.move_to_end(oid)
+                return self.entries[oid]
+            except KeyError:
+                return None
+
+    def put(self, oid, info):
+        with self.lock:
+            self.entries[oid] = info
+            self.entries.move_to_end(oid)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+_base_cache = DeltaBaseCache(settings.DELTA_BASE_CACHE_LIMIT)
+_info_cache = InfoCache(settings.OBJECT_INFO_CACHE_SIZE)
+_counters = threading.local()
+
+
+def reset_counters():
+    """Start counting delta applications for a new request on this thread"""
+    _counters.delta_applications = 0
+
+
+def delta_applications():
+    return getattr(_counters, "delta_applications", 0)
+
+
+def read_varint(delta, pos):
+    value = shift = 0
+    while True:
+        byte = delta[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def apply_delta(base, delta):
+    """Rebuild an object from its base and a git delta"""
+    base_size, pos = read_varint(delta, 0)
+    if base_size != len(base):
+        raise ValueError("delta base size mismatch")
+    result_size, pos = read_varint(delta, pos)
+    base = memoryview(base)
+    out = bytearray()
+    end = len(delta)
+    while pos < end:
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            offset = size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            out += base[offset : offset + (size or 0x10000)]
+        elif op:
+            out += delta[pos : pos + op]
+            pos += op
+        else:
+            raise ValueError("invalid delta opcode")
+    if len(out) != result_size:
+        raise ValueError("delta result size mismatch")
+    _counters.delta_applications = delta_applications() + 1
+    return bytes(out)
+
+
+def delta_chunks(base, delta):
+    """Lazily rebuild an object from its base and a git delta
+
+    Yields the output of each copy and insert instruction as it goes, at
+    most INFLATE_CHUNK bytes at a time, so only the base and the delta are
+    held in memory.
+    """
+    base_size, pos = read_varint(delta, 0)
+    if base_size != len(base):
+        raise ValueError("delta base size mismatch")
+    result_size, pos = read_varint(delta, pos)
+    _counters.delta_applications = delta_applications() + 1
+    base = memoryview(base)
+    delta = memoryview(delta)
+    written = 0
+    end = len(delta)
+    while pos < end:
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            offset = size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            size = size or 0x10000
+            if offset + size > len(base):
+                raise ValueError("delta copies past the end of its base")
+            for start in range(offset, offset + size, INFLATE_CHUNK):
+                yield bytes(base[start : min(start + INFLATE_CHUNK, offset + size)])
+            written += size
+        elif op:
+            yield bytes(delta[pos : pos + op])
+            pos += op
+            written += op
+        else:
+            raise ValueError("invalid delta opcode")
+    if written != result_size:
+        raise ValueError("delta result size mismatch")
+
+
+class ObjectDatabase:
+    """Raw object access for a repository's packs and loose objects"""
+
+    def __init__(self, path):
+        self.graph = commitgraph.open_graph(path)
+        self.objects_dir = os.path.join(path, ".git", "objects")
+        pack_dir = os.path.join(self.objects_dir, "pack")
+        self.packs = []
+        try:
+            names = sorted(os.listdir(pack_dir))
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            if name.endswith(".pack"):
+                self.packs.append(Pack(os.path.join(pack_dir, name)))
+
+    def locate(self, oid):
+        """Find (pack, offset) for a binary oid, or None if not packed"""
+        for pack in self.packs:
+            offset = pack.index.find(oid)
+            if offset is not None:
+                return pack, offset
+        return None
+
+    def loose_path(self, oid):
+        hex_oid = oid.hex()
+        return os.path.join(self.objects_dir, hex_oid[:2], hex_oid[2:])
+
+    def read_loose(self, oid):
+        try:
+            with open(self.loose_path(oid), "rb") as f:
+                raw = zlib.decompress(f.read())
+        except FileNotFoundError:
+            return None
+        header, _, data = raw.partition(b"\0")
+        type, _ = header.split(b" ")
+        return type.decode(), data
+
+    def loose_header(self, path):
+        """Parse the type and size of a loose object, inflating only its header"""
+        header = b""
+        for chunk in inflate_chunks(file_chunks(path)):
+            header += chunk
+            if b"\0" in header:
+                break
+        type, size = header[: header.index(b"\0")].split(b" ")
+        return type.decode(), int(size)
+
+    def loose_data_chunks(self, path):
+        in_header = True
+        for chunk in inflate_chunks(file_chunks(path)):
+            if in_header:
+                nul = chunk.find(b"\0")
+                if nul < 0:
+                    continue
+                chunk = chunk[nul + 1 :]
+                in_header = False
+            yield chunk
+
+    def packed_info(self, pack, offset):
+        type, size, pos, base = pack.header(offset)
+        if type not in (OBJ_OFS_DELTA, OBJ_REF_DELTA):
+            return TYPE_NAMES[type], size
+
+        # A delta starts with the base and result sizes
+        head = inflate_head(pack.view, pos, 20)
+        _, head_pos = read_varint(head, 0)
+        size, _ = read_varint(head, head_pos)
+
+        # While the type is that of the base at the end of the chain
+        while type in (OBJ_OFS_DELTA, OBJ_REF_DELTA):
+            if type == OBJ_REF_DELTA:
+                found = self.locate(base)
+                if found is None:
+                    type, _ = self.loose_header(self.loose_path(base))
+                    return type, size
+                pack, base = found
+            type, _, _, base = pack.header(base)
+        return TYPE_NAMES[type], size
+
+    def info(self, oid):
+        """Type name and size of the object with hex oid, or None if missing
+
+        Only object headers are read, the data itself is never inflated
+        beyond the first few bytes of a delta.
+        """
+        cached = _info_cache.get(oid)
+        if cached is not None:
+            return cached[:2]
+
+        found = self.locate(bytes.fromhex(oid))
+        if found is not None:
+            info = self.packed_info(*found)
+        else:
+            try:
+                info = self.loose_header(self.loose_path(bytes.fromhex(oid)))
+            except FileNotFoundError:
+                return None
+        _info_cache.put(oid, (*info, None))
+        return info
+
+    def is_binary(self, oid):
+        """Whether a blob has a NUL byte among its first few bytes, like git"""
+        cached = _info_cache.get(oid)
+        if cached is not None and cached[2] is not None:
+            return cached[2]
+
+        stream = self.open(oid)
+        binary = b"\0" in b"".join(stream.chunks(0, FIRST_FEW_BYTES))
+        _info_cache.put(oid, (stream.type, stream.size, binary))
+        return binary
+
+    def open(self, oid):
+        """Open the object with hex oid for streaming, or None if missing
+
+        Undeltified packed objects and loose objects are inflated as they
+        are read. For deltified objects only the base is rebuilt in full,
+        the last delta is applied as the data is read.
+        """
+        oid = bytes.fromhex(oid)
+        found = self.locate(oid)
+        if found is not None:
+            pack, offset = found
+            type, size, pos, base = pack.header(offset)
+            if type in (OBJ_OFS_DELTA, OBJ_REF_DELTA):
+                delta = inflate(pack.view, pos, size)
+                if type == OBJ_OFS_DELTA:
+                    type, base_data = self.read_packed(pack, base)
+                else:
+                    base_found = self.locate(base)
+                    if base_found is not None:
+                        type, base_data = self.read_packed(*base_found)
+                    else:
+                        type, base_data = self.read_loose(base)
+                _, pos = read_varint(delta, 0)
+                result_size, _ = read_varint(delta, pos)
+                return ObjectStream(type, result_size, lambda: delta_chunks(base_data, delta))
+            return ObjectStream(
+                TYPE_NAMES[type], size, lambda: inflate_chunks(view_chunks(pack.view, pos))
+            )
+
+        path = self.loose_path(oid)
+        try:
+            type, size = self.loose_header(path)
+        except FileNotFoundError:
+            return None
+        return ObjectStream(type, size, lambda: self.loose_data_chunks(path))
+
+    def read_packed(self, pack, offset):
+        """Reconstruct a packed object, resolving any delta chain
+
+        The chain is followed down to the nearest base already in the delta
+        base cache, and every base rebuilt on the way back up is cached.
+        """
+        deltas = []
+        while True:
+            key = (pack.path, offset)
+            if deltas:
+                cached = _base_cache.get(key)
+                if cached is not None:
+                    type, data = cached
+                    break
+            type, size, pos, base = pack.header(offset)
+            data = inflate(pack.view, pos, size)
+            if type == OBJ_OFS_DELTA:
+                deltas.append((key, data))
+                offset = base
+            elif type == OBJ_REF_DELTA:
+                deltas.append((key, data))
+                found = self.locate(base)
+                if found is None:
+                    type, data = self.read_loose(base)
+                    break
+                pack, offset = found
+            else:
+                type = TYPE_NAMES[type]
+                if deltas:
+                    _base_cache.put(key, type, data)
+                break
+
+        while deltas:
+            key, delta = deltas.pop()
+            data = apply_delta(data, delta)
+            if deltas:
+                _base_cache.put(key, type, data)
+        return type, data
+
+    def read(self, oid):
+        """Read (type name, data) of the object with hex oid, or None"""
+        oid = bytes.fromhex(oid)
+        found = self.locate(oid)
+        if found is not None:
+            return self.read_packed(*found)
+        return self.read_loose(oid)
+
+    def commit_header(self, oid):
+        """Tree, parents and committer date of a commit
+
+        These come from the commit-graph when it covers the commit, otherwise
+        the commit object is read and only its header parsed.
+        """
+        if self.graph is not None:
+            commit = self.graph.commit(oid)
+            if commit is not None:
+                return commit
+        return CommitHeader(oid, self.read(oid)[1])
+
+
+def parse_tree(data):
+    """Yield (mode, name, hex oid) for each entry of raw tree data"""
+    pos = 0
+    end = len(data)
+    while pos < end:
+        space = data.index(b" ", pos)
+        nul = data.index(b"\0", space)
+        yield data[pos:space].decode(), data[space + 1 : nul].decode(), data[nul + 1 : nul + 21].hex()
+        pos = nul + 21
+
+
+class CommitHeader:
+    """The fields of a raw commit needed to walk history"""
+
+    def __init__(self, oid, data):
+        self.oid = oid
+        self.parents = []
+        for line in data[: data.find(b"\n\n")].split(b"\n"):
+            key, _, value = line.partition(b" ")
+            if key == b"tree":
+                self.tree = value.decode()
+            elif key == b"parent":
+                self.parents.append(value.decode())
+            elif key == b"committer":
+                self.timestamp = int(value.rsplit(b" ", 2)[1])
+
+
+class Signature:
+    def __init__(self, value):
+        ident, timestamp, _ = value.rsplit(" ", 2)
+        self.name, _, email = ident.partition(" <")
+        self.email = email.rstrip(">")
+        self.timestamp = int(timestamp)
+
+
+class CommitSummary:
+    """A commit for log listings, parsing only the fields that get rendered"""
+
+    def __init__(self, oid, data):
+        self.oid = oid
+        self.short_oid = oid[:7]
+        self.data = data
+
+    @functools.cached_property
+    def committer(self):
+        start = self.data.index(b"\ncommitter ") + 11
+        end = self.data.index(b"\n", start)
+        return Signature(self.data[start:end].decode(errors="replace"))
+
+    @functools.cached_property
+    def message(self):
+        return self.data[self.data.find(b"\n\n") + 2 :].decode(errors="replace")
@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+
+# Response headers that are part of a cached page
+STORED_HEADERS = ("Content-Type", "Content-Disposition", "Accept-Ranges")
+
+
+def page_cache():
+    return caches[settings.PAGE_CACHE_ALIAS]
+
+
+def load(key):
+    """Rebuild a cached page response, None if it is not cached"""
+    entry = page_cache().get(key)
+    if entry is None:
+        return None
+    status, headers, content = entry
+    response = HttpResponse(content, status=status)
+    for name, value in headers:
+        response[name] = value
+    return response
+
+
+def store(key, response):
+    """Cache a page response if it is worth keeping
+
+    Errors, responses setting cookies and pages larger than
+    PAGE_CACHE_MAX_ENTRY_BYTES are left alone. Streaming responses are cached
+    once all of their content has been sent.
+    """
+    if response.status_code != 200 or response.cookies:
+        return
+    headers = [(name, response[name]) for name in STORED_HEADERS if response.has_header(name)]
+    if response.streaming:
+        response.streaming_content = collect(key, headers, response.streaming_content)
+        return
+    if len(response.content) > settings.PAGE_CACHE_MAX_ENTRY_BYTES:
+        return
+    page_cache().set(key, (response.status_code, headers, response.content))
+
+
+def collect(key, headers, chunks):
+    """Pass streamed chunks through, caching the page after the last one"""
+    parts = []
+    size = 0
+    for chunk in chunks:
+        yield chunk
+        if parts is None:
+            continue
+        size += len(chunk)
+        if size > settings.PAGE_CACHE_MAX_ENTRY_BYTES:
+            parts = None
+        else:
+            parts.append(chunk)
+    if parts is not None:
+        page_cache().set(key, (200, headers, b"".join(parts)))
@@ -0,0 +1,98 @@
+import enum
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from mfgd_app.models import CanAccess, Repository
+
+VERSION_KEY = "permissions:version"
+
+
+class Permission(enum.IntEnum):
+    NO_ACCESS = 0
+    CAN_VIEW = 1
+    CAN_MANAGE = 2
+
+
+def permission_cache():
+    return caches[settings.PERMISSION_CACHE_ALIAS]
+
+
+def cache_timeout(cache):
+    # Bumping the version only reaches other workers through a shared cache,
+    # maps in a per-process one must expire before a revoked grant matters
+    if isinstance(cache, LocMemCache):
+        return min(settings.PERMISSION_CACHE_TIMEOUT, settings.PERMISSION_LOCAL_CACHE_TIMEOUT)
+    return settings.PERMISSION_CACHE_TIMEOUT
+
+
+def new_version():
+    # Never reuses a version a map may still be cached under, even if the
+    # version key itself was evicted
+    return time.time_ns()
+
+
+def current_version(cache):
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, new_version(), timeout=None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def invalidate():
+    """Retire every cached permission map"""
+    cache = permission_cache()
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, new_version(), timeout=None)
+
+
+def build_permission_map(user):
+    permissions = {
+        name: Permission.CAN_VIEW if public else Permission.NO_ACCESS
+        for name, public in Repository.objects.values_list("name", "isPublic")
+    }
+    if not user.is_anonymous:
+        accesses = CanAccess.objects.filter(user__user=user).values_list("repo_id", "canManage")
+        for name, manage in accesses:
+            permissions[name] = Permission.CAN_MANAGE if manage else Permission.CAN_VIEW
+    return permissions
+
+
+def permission_map(user):
+    """{repository name: Permission} for a user, anonymous or not
+
+    Every repository is in the map. Maps are cached under the current
+    version, which any change to a repository or access grant bumps. A
+    per-process cache only keeps them for PERMISSION_LOCAL_CACHE_TIMEOUT.
+    """
+    cache = permission_cache()
+    key = f"permissions:{current_version(cache)}:{user.pk or 0}"
+    permissions = cache.get(key)
+    if permissions is None:
+        permissions = build_permission_map(user)
+        cache.set(key, permissions, cache_timeout(cache))
+    return permissions
+
+
+def accessible_repositories(user):
+    """Names of the repositories a user can see"""
+    return [
+        name
+        for name, permission in permission_map(user).items()
+        if permission != Permission.NO_ACCESS
+    ]
+
+
+@receiver(post_save, sender=Repository)
+@receiver(post_delete, sender=Repository)
+@receiver(post_save, sender=CanAccess)
+@receiver(post_delete, sender=CanAccess)
+def invalidate_permissions(sender, **kwargs):
+    invalidate()
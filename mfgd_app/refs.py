@@ -0,0 +1,248 @@
+import bisect
+import collections
+import heapq
+import os
+import re
+import threading
+
+from django.conf import settings
+
+from mfgd_app import odb
+
+# Where a name given in a URL is looked for, branches before tags
+REF_PREFIXES = ("refs/heads/", "refs/tags/")
+# Ref names a URL can address, like the oid segment of the URL patterns
+name_re = re.compile(r"\w+")
+
+
+def git_dir(repo_path):
+    return os.path.join(repo_path, ".git")
+
+
+def read_loose(repo_path, ref):
+    """Contents of a loose ref file, or None if there is none"""
+    try:
+        with open(os.path.join(git_dir(repo_path), ref)) as f:
+            return f.read().strip()
+    except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+        return None
+
+
+class RefTable:
+    """Every ref of a repository, read once and reloaded when it changes
+
+    Holds the loose and packed refs, where HEAD points and the commits that
+    packed annotated tags peel to. Loose annotated tags are peeled on first
+    use. The table is stale once packed-refs, HEAD or any directory below
+    refs has a different mtime than when it was read.
+    """
+
+    def __init__(self, repo_path):
+        self.repo_path = repo_path
+        self.lock = threading.Lock()
+        self.refs = {}
+        self.peeled = {}
+        self.head = None
+        self.dirs = []
+        self.stamp = None
+        self.sorted_branches = None
+        self.sorted_refs = None
+        self.recent = None
+        # Committer dates of branch tips, kept across reloads for tips that
+        # did not move
+        self.commit_times = {}
+        self.load()
+
+    def current_stamp(self):
+        times = []
+        root = git_dir(self.repo_path)
+        for name in ["HEAD", "packed-refs"] + self.dirs:
+            try:
+                times.append(os.stat(os.path.join(root, name)).st_mtime_ns)
+            except FileNotFoundError:
+                times.append(None)
+        return tuple(times)
+
+    def load(self):
+        root = git_dir(self.repo_path)
+        refs = {}
+        peeled = {}
+        last = None
+        try:
+            with open(os.path.join(root, "packed-refs")) as f:
+                for line in f:
+                    line = line.rstrip("\n")
+                    if line.startswith("#"):
+                        continue
+                    if line.startswith("^"):
+                        if last is not None:
+                            peeled[last] = line[1:]
+                        continue
+                    oid, _, last = line.partition(" ")
+                    refs[last] = oid
+        except FileNotFoundError:
+            pass
+
+        # Loose refs take precedence over packed ones
+        dirs = []
+        for directory, _, names in os.walk(os.path.join(root, "refs")):
+            dirs.append(os.path.relpath(directory, root))
+            for name in names:
+                ref = os.path.relpath(os.path.join(directory, name), root).replace(os.sep, "/")
+                oid = read_loose(self.repo_path, ref)
+                if oid is not None and odb.oid_re.fullmatch(oid):
+                    refs[ref] = oid
+                    peeled.pop(ref, None)
+
+        head = read_loose(self.repo_path, "HEAD")
+        self.refs = refs
+        self.peeled = peeled
+        self.head = head
+        self.dirs = dirs
+        self.sorted_branches = None
+        self.sorted_refs = None
+        self.recent = None
+        tips = set(refs.values())
+        self.commit_times = {
+            oid: time for oid, time in self.commit_times.items() if oid in tips
+        }
+        self.stamp = self.current_stamp()
+
+    def refresh(self):
+        """Reload if the ref files changed since they were read"""
+        with self.lock:
+            if self.current_stamp() != self.stamp:
+                self.load()
+
+    def head_branch(self):
+        """Branch HEAD points to, None if HEAD is detached or unreadable"""
+        if self.head is None or not self.head.startswith("ref: refs/heads/"):
+            return None
+        return self.head[len("ref: refs/heads/") :]
+
+    def head_oid(self):
+        if self.head is None:
+            return None
+        if self.head.startswith("ref: "):
+            return self.refs.get(self.head[5:])
+        return self.head if odb.oid_re.fullmatch(self.head) else None
+
+    def branches(self):
+        """Branch names in sorted order"""
+        if self.sorted_branches is None:
+            self.sorted_branches = sorted(
+                ref[len("refs/heads/") :] for ref in self.refs if ref.startswith("refs/heads/")
+            )
+        return self.sorted_branches
+
+    def ref_index(self):
+        """(short name, kind) of every branch and tag a URL can name, sorted"""
+        if self.sorted_refs is None:
+            index = []
+            for ref in self.refs:
+                for prefix, kind in (("refs/heads/", "branch"), ("refs/tags/", "tag")):
+                    if ref.startswith(prefix) and name_re.fullmatch(ref[len(prefix) :]):
+                        index.append((ref[len(prefix) :], kind))
+            index.sort()
+            self.sorted_refs = index
+        return self.sorted_refs
+
+    def search(self, prefix, offset=0, limit=50):
+        """Page of (short name, kind) of the refs starting with prefix
+
+        Returns the page and whether more refs match after it.
+        """
+        index = self.ref_index()
+        start = bisect.bisect_left(index, (prefix,)) + offset
+        matches = []
+        for name, kind in index[start : start + limit + 1]:
+            if not name.startswith(prefix):
+                break
+            matches.append((name, kind))
+        return matches[:limit], len(matches) > limit
+
+    def recent_branches(self, db, count):
+        """Names of the count branches a URL can name whose tips were committed last"""
+        if self.recent is None or len(self.recent) < count:
+
+            def commit_time(name):
+                oid = self.refs["refs/heads/" + name]
+                if oid not in self.commit_times:
+                    header = db.commit_header(oid) if db.info(oid) is not None else None
+                    self.commit_times[oid] = header.timestamp if header is not None else 0
+                return self.commit_times[oid]
+
+            routable = [name for name in self.branches() if name_re.fullmatch(name)]
+            self.recent = heapq.nlargest(count, routable, key=commit_time)
+        return self.recent[:count]
+
+    def peel(self, ref):
+        """Commit a ref points to, looking through annotated tags"""
+        oid = self.refs[ref]
+        if ref in self.peeled:
+            return self.peeled[ref]
+        if not ref.startswith("refs/tags/"):
+            return oid
+
+        db = odb.ObjectDatabase(self.repo_path)
+        target = oid
+        for _ in range(5):
+            info = db.info(target)
+            if info is None or info[0] != "tag":
+                break
+            data = db.read(target)[1]
+            target = data[len(b"object ") : data.index(b"\n")].decode()
+        self.peeled[ref] = target
+        return target
+
+    def resolve(self, name):
+        """Commit oid a branch, tag or HEAD names, None if there is no such ref"""
+        if name == "HEAD":
+            return self.head_oid()
+        if not name_re.fullmatch(name):
+            return None
+        for prefix in REF_PREFIXES:
+            if prefix + name in self.refs:
+                return self.peel(prefix + name)
+        return None
+
+
+class RefTables:
+    """Bounded LRU of ref tables keyed by repository path"""
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.tables = collections.OrderedDict()
+
+    def get(self, repo_path):
+        with self.lock:
+            table = self.tables.get(repo_path)
+            if table is not None:
+                self.tables.move_to_end(repo_path)
+        if table is None:
+            table = RefTable(repo_path)
+            with self.lock:
+                self.tables[repo_path] = table
+                while len(self.tables) > self.size:
+                    self.tables.popitem(last=False)
+        else:
+            table.refresh()
+        return table
+
+
+_tables = RefTables(settings.REF_TABLE_CACHE_SIZE)
+
+
+def ref_table(repo_path):
+    """Up to date ref table of a repository"""
+    return _tables.get(repo_path)
+
+
+def resolve(repo_path, name):
+    """Commit oid a branch, tag or HEAD points to, None if there is no such ref
+
+    Only reads the ref files, so it is cheap enough to run before the
+    repository is opened.
+    """
+    return ref_table(repo_path).resolve(name)
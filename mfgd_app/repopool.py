@@ -0,0 +1,91 @@
+import collections
+import os
+import threading
+
+from django.conf import settings
+from mpygit import mpygit
+
+from mfgd_app import objcache, odb
+
+
+def disk_stamp(path):
+    """Modification times of the files an open repository handle caches"""
+    git_dir = os.path.join(path, ".git")
+    stamp = []
+    names = (
+        "HEAD",
+        "packed-refs",
+        "refs",
+        "refs/heads",
+        "refs/tags",
+        "objects/pack",
+        "objects/info/commit-graph",
+    )
+    for name in names:
+        try:
+            stamp.append(os.stat(os.path.join(git_dir, name)).st_mtime_ns)
+        except FileNotFoundError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+class RepositoryPool:
+    """Bounded LRU pool of open repositories keyed by path
+
+    A pooled handle is reopened once the refs or pack directory it was opened
+    against change on disk.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.handles = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, path):
+        stamp = disk_stamp(path)
+        with self.lock:
+            try:
+                old_stamp, repo = self.handles[path]
+                if old_stamp == stamp:
+                    self.handles.move_to_end(path)
+                    self.hits += 1
+                    return repo
+                del self.handles[path]
+                self.invalidations += 1
+            except KeyError:
+                pass
+            self.misses += 1
+
+        repo = objcache.wrap(mpygit.Repository(path))
+        repo.odb = odb.ObjectDatabase(path)
+        with self.lock:
+            self.handles[path] = (stamp, repo)
+            self.handles.move_to_end(path)
+            while len(self.handles) > self.size:
+                self.handles.popitem(last=False)
+        return repo
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.handles),
+                "capacity": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+            }
+
+
+_pool = RepositoryPool(settings.REPOSITORY_POOL_SIZE)
+
+
+def open_repository(path):
+    """Get an open repository from the process-wide pool"""
+    return _pool.get(path)
+
+
+def pool_stats():
+    return _pool.stats()
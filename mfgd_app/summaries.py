@@ -0,0 +1,60 @@
+import datetime
+import hashlib
+import os
+
+from mfgd_app import refs, repopool
+from mfgd_app.models import RepositorySummary
+
+
+def stat_key(path):
+    return hashlib.sha1(repr((path, refs.ref_table(path).stamp)).encode()).hexdigest()
+
+
+def objects_size(path):
+    """Bytes used by a repository's objects on disk"""
+    size = 0
+    for directory, _, names in os.walk(os.path.join(refs.git_dir(path), "objects")):
+        for name in names:
+            try:
+                size += os.stat(os.path.join(directory, name)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def read_summary(db_repo, key):
+    path = db_repo.path
+    summary = RepositorySummary(repo=db_repo, statKey=key)
+    table = refs.ref_table(path)
+    summary.defaultBranch = table.head_branch() or ""
+    summary.headOid = table.head_oid() or ""
+    summary.branchCount = len(table.branches())
+    summary.size = objects_size(path)
+    if summary.headOid:
+        db = repopool.open_repository(path).odb
+        if db.info(summary.headOid) is not None:
+            header = db.commit_header(summary.headOid)
+            summary.lastCommitDate = datetime.datetime.fromtimestamp(
+                header.timestamp, datetime.timezone.utc
+            )
+    return summary
+
+
+def refresh(db_repos):
+    """Attach an up to date summary to each repository as .summary
+
+    Only the HEAD and ref files are stat'ed for repositories whose stored
+    summary is current, the rest are read from disk and saved. Query the
+    repositories with select_related("summary") to avoid a lookup each.
+    """
+    for db_repo in db_repos:
+        key = stat_key(db_repo.path)
+        try:
+            summary = db_repo.summary
+        except RepositorySummary.DoesNotExist:
+            summary = None
+        if summary is not None and summary.statKey == key:
+            continue
+        summary = read_summary(db_repo, key)
+        summary.save()
+        db_repo.summary = summary
@@ -1,20 +1,20 @@
-import enum
-import binascii
 import difflib
+import heapq
 import re
 import string
 
-from mpygit import mpygit, gitutil
+from mpygit import mpygit
 
 from pygments import highlight
-from pygments.lexers import get_lexer_for_filename
 from pygments.formatters import HtmlFormatter
 
 from django.utils.html import escape
-from mfgd_app.models import Repository, UserProfile, CanAccess
+from mfgd_app import changeindex, history, htmlcache, lexers
+from mfgd_app.permissions import Permission, permission_map
 
 # Pre-compiled regex for speed
 split_path_re = re.compile(r"/?([^/]+)/?")
+range_re = re.compile(r"bytes=(\d*)-(\d*)")
 
 
 def split_path(path):
@@ -27,87 +27,164 @@ def normalize_path(path):
     return "/".join(split_path(path))
 
 
-def resolve_path(repo, oid, path):
-    # Resolve tree id
-    tree = repo[oid]
-
-    # Check for root of tree
-    path = path.strip("/")
-    if path == "":
-        return tree
-
-    for path_entry in path.split("/"):
+def resolve_oid(repo, oid, path):
+    """Resolve a path inside a tree to an oid without loading the target"""
+    for path_entry in split_path(path):
+        tree = repo[oid]
         if not isinstance(tree, mpygit.Tree):
             return None
         tree_entry = tree[path_entry]
         if tree_entry == None:
             return None
-        tree = repo[tree_entry.oid]
+        oid = tree_entry.oid
+    return oid
 
-    return tree
 
-def hex_dump(binary):
-    ALLOWED_CHARS = set(string.ascii_letters + string.digits + string.punctuation)
-    N_BYTES_ROW = 16
-    N_BYTES_COL = 8
-    N_BYTES_CHUNK = 1
+def parse_range(header, size):
+    """Parse a single byte range header into a [start, end) pair
 
-    rows = []
-    for row_off in range(0, len(binary), N_BYTES_ROW):
-        row = binary[row_off : row_off + N_BYTES_ROW]
-        chunks = []
-        ascii = ""
-        for chunk_off in range(0, len(row), N_BYTES_CHUNK):
-            chunk = row[chunk_off : chunk_off + N_BYTES_CHUNK]
-            for char in map(chr, chunk):
-                if char in ALLOWED_CHARS:
-                    ascii += char
-                else:
-                    ascii += "."
-            chunks.append(binascii.b2a_hex(chunk).decode())
-
-        cols = []
-        for col_off in range(0, len(chunks), N_BYTES_COL):
-            cols.append(" ".join(chunks[col_off : col_off + N_BYTES_COL]))
-
-        offset = "{:08x}".format(row_off)
-        rows.append((offset, cols, ascii))
+    Returns None for headers that should be ignored, like malformed ones or
+    ones asking for several ranges, and raises ValueError for ranges that
+    cannot be satisfied.
+    """
+    match = range_re.fullmatch(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = int(last) + 1 if last else size
+        if last and end <= start:
+            return None
+        if start >= size:
+            raise ValueError("range starts past the end")
+        return start, min(end, size)
+    if last:
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError("empty suffix range")
+        return max(size - length, 0), size
+    return None
+
+
+HEX_ROW_BYTES = 16
+HEX_COL_BYTES = 8
+# Maps every byte to itself if printable, otherwise to "."
+HEX_ASCII_TABLE = bytes(
+    c if chr(c) in string.ascii_letters + string.digits + string.punctuation else ord(".")
+    for c in range(256)
+)
+
+
+def hex_dump(binary, offset=0, length=None, base=0):
+    """Hex dump rows of binary[offset:offset + length]
+
+    The whole window is converted with bulk bytes operations up front, the
+    rows are then just slices of the hex and ASCII strings. Row addresses
+    start at base, for dumping a window already cut out of a larger blob.
+    """
+    offset -= offset % HEX_ROW_BYTES
+    end = len(binary) if length is None else min(len(binary), offset + length)
+    window = bytes(memoryview(binary)[offset:end])
+    # Three characters per byte, two hex digits and a separating space
+    hexed = window.hex(" ")
+    ascii = window.translate(HEX_ASCII_TABLE).decode("ascii")
+
+    # Full rows share the same column layout, only the last one can be short
+    spans = [
+        (col * 3, (col + HEX_COL_BYTES) * 3 - 1)
+        for col in range(0, HEX_ROW_BYTES, HEX_COL_BYTES)
+    ]
+    full = len(window) - len(window) % HEX_ROW_BYTES
+    rows = [
+        (
+            f"{base + offset + row_off:08x}",
+            [hexed[row_off * 3 + start : row_off * 3 + end] for start, end in spans],
+            ascii[row_off : row_off + HEX_ROW_BYTES],
+        )
+        for row_off in range(0, full, HEX_ROW_BYTES)
+    ]
+    if full < len(window):
+        cols = [
+            hexed[col_off * 3 : min(col_off + HEX_COL_BYTES, len(window)) * 3 - 1]
+            for col_off in range(full, len(window), HEX_COL_BYTES)
+        ]
+        rows.append((f"{base + offset + full:08x}", cols, ascii[full:]))
     return rows
 
 
-def tree_entries(repo, target, path, tree):
-    clean_entries = []
-    for entry in tree:
-        entry.last_change = gitutil.get_latest_change(repo, \
-                                target.oid, (*split_path(path), entry.name))
-        if not entry.isdir() and not entry.issubmod():
-            blob = repo[entry.oid]
-            entry.is_binary = blob.is_binary
-        clean_entries.append(entry)
+def tree_page(tree, offset, limit):
+    """One page of a tree's entries, directories first and then by name
+
+    Returns the page along with the total number of entries. Only the entries
+    up to the end of the page are ever put in order.
+    """
+    entries = list(tree)
+
+    def order(entry):
+        return not entry.isdir(), entry.name
+
+    end = offset + limit
+    if end < len(entries):
+        page = heapq.nsmallest(end, entries, key=order)[offset:]
+    else:
+        page = sorted(entries, key=order)[offset:end]
+    return page, len(entries)
+
+
+class TreeRow:
+    """A tree entry annotated for one listing
+
+    Parsed trees are shared between requests through the object cache, so
+    what a listing adds to an entry lives here instead of on the entry.
+    """
+
+    def __init__(self, entry, last_change, is_binary):
+        self.entry = entry
+        self.name = entry.name
+        self.oid = entry.oid
+        self.last_change = last_change
+        self.is_binary = is_binary
 
-    # secondary sort by name
-    clean_entries.sort(key=lambda entry: entry.name)
-    # primary sort by type
-    clean_entries.sort(key=lambda entry: entry.isdir(), reverse=True)
-    return clean_entries
+    def isdir(self):
+        return self.entry.isdir()
 
+    def issubmod(self):
+        return self.entry.issubmod()
 
-def highlight_code(filename, code):
+
+def tree_entries(repo, target, path, entries):
+    """Rows for tree entries with their last change and binary-ness"""
+    changes = history.get_latest_changes(
+        repo,
+        target.oid,
+        split_path(path),
+        [entry.name for entry in entries],
+        changeindex.open_index(repo.path),
+    )
+
+    rows = []
+    for entry in entries:
+        is_binary = False
+        if not entry.isdir() and not entry.issubmod():
+            is_binary = repo.odb.is_binary(entry.oid)
+        rows.append(TreeRow(entry, changes.get(entry.name), is_binary))
+    return rows
+
+
+def highlight_code(filename, code, oid=None):
+    """Highlight code as HTML, cached by blob oid when one is given"""
     if code is None:
         return None
 
-    try:
-        lexer = get_lexer_for_filename(filename, stripall=True)
-    except:
-        lexer = get_lexer_for_filename("name.txt", stripall=True)
+    lexer = lexers.lexer_for_filename(filename)
     formatter = HtmlFormatter(linenos=True)
-    return highlight(code, lexer, formatter)
+    if oid is None:
+        return highlight(code, lexer, formatter)
 
+    key = (oid, lexer.name, sorted(lexer.options.items()), "html", ("linenos", True))
+    return htmlcache.get_or_render(key, lambda: highlight(code, lexer, formatter))
 
-class Permission(enum.IntEnum):
-    NO_ACCESS = 0
-    CAN_VIEW = 1
-    CAN_MANAGE = 2
 
 def verify_user_permissions(endpoint):
     def _inner(request, *args, **kwargs):
@@ -116,26 +193,8 @@ def verify_user_permissions(endpoint):
         except KeyError:
             return endpoint(request, Permission.CAN_VIEW, *args, **kwargs)
 
-        # check if repository is public or exists
-        permission = Permission.CAN_VIEW
-        try:
-            repo = Repository.objects.get(name=repo_name)
-            permission = Permission.CAN_VIEW if repo.isPublic else Permission.NO_ACCESS
-        except Repository.DoesNotExist:  # let view handle failure
-            return endpoint(request, Permission.CAN_VIEW, *args, **kwargs)
-
-        if request.user.is_anonymous:
-            return endpoint(request, permission, *args, **kwargs)
-
-        # check if user has valid permissions
-        try:
-            access = CanAccess.objects.get(user=request.user.userprofile, repo=repo)
-            if access.canManage:
-                permission = Permission.CAN_MANAGE
-            else:
-                permission = Permission.CAN_VIEW
-        except (UserProfile.DoesNotExist, CanAccess.DoesNotExist):
-            pass
+        # Repositories missing from the map do not exist, let view handle failure
+        permission = permission_map(request.user).get(repo_name, Permission.CAN_VIEW)
         return endpoint(request, permission, *args, **kwargs)
 
     return _inner
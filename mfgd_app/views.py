@@ -1,65 +1,112 @@
 import binascii
+import itertools
 import json
-import re
+import mimetypes
 
-from django.http import HttpResponse, Http404
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import transaction
+from django.db.models import FilteredRelation, Q
+from django.http import HttpResponse, Http404, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
+from django.template.loader import render_to_string
 from django.urls import reverse
+from django.utils.html import format_html
 from django import urls
 from pathlib import Path
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import requires_csrf_token
-from mpygit import mpygit, gitutil
-
-from mfgd_app import utils
+from mpygit import mpygit
+
+from mfgd_app import (
+    changeindex,
+    diff,
+    history,
+    odb,
+    permissions,
+    refs,
+    repopool,
+    summaries,
+    utils,
+)
+from mfgd_app.httpcache import (
+    REF_MARKER,
+    conditional_on_commit,
+    fill_in_context,
+    mark_incomplete,
+)
 from mfgd_app.utils import verify_user_permissions, Permission
 from mfgd_app.models import Repository, CanAccess, UserProfile
 from mfgd_app.forms import UserForm, RepoForm, UserUpdateForm, ProfileUpdateForm, PasswordForm
 from django.contrib.auth import update_session_auth_hash
 
+# Stands in for the rows of tree.html, which are streamed separately
+TREE_ROWS_MARKER = "<!-- tree rows -->"
+# Rows rendered per chunk of a streamed tree listing
+TREE_ROWS_PER_CHUNK = 100
 
 
 def default_branch(db_repo_obj):
-    # NOTE: someone please fix this if you can, but the pygit2 API does not
-    # provide access to the global HEAD as it's not a proper ref
-    with open(db_repo_obj.path + "/.git/HEAD") as f:
-        return f.read().split("/")[-1].strip()
+    # A detached HEAD has no branch, fall back to HEAD itself
+    return refs.ref_table(db_repo_obj.path).head_branch() or "HEAD"
+
+
+def lookup_commit(repo, oid):
+    """Commit named by an oid, branch, tag or HEAD, None if there is none"""
+    if not odb.oid_re.fullmatch(oid):
+        # Resolving to the full oid lets the object cache serve the commit
+        target = refs.ref_table(repo.path).resolve(oid)
+        if target is not None:
+            oid = target
+    commit = repo[oid]
+    return commit if isinstance(commit, mpygit.Commit) else None
 
 
 def index(request):
     context_dict = {}
-    accessible_repos = Repository.objects.filter(isPublic=True)
-    if not request.user.is_anonymous:
-        try:
-            profile = UserProfile.objects.get(user=request.user)
-            restricted_repos = Repository.objects.all().filter(
-                canaccess__user__pk=profile.id
-            )
-            accessible_repos = accessible_repos.union(restricted_repos)
-        except UserProfile.DoesNotExist:
-            pass
+    accessible_repos = (
+        Repository.objects.filter(name__in=permissions.accessible_repositories(request.user))
+        .select_related("summary")
+        .order_by("name")
+    )
+    query = request.GET.get("q", "").strip()
+    if query:
+        accessible_repos = accessible_repos.filter(name__icontains=query)
 
-    for repo in accessible_repos:
-        repo.default_branch = default_branch(repo)
+    # Only the repositories on this page are checked against the disk
+    page = Paginator(accessible_repos, settings.DASHBOARD_PAGE_SIZE).get_page(
+        request.GET.get("page")
+    )
+    summaries.refresh(page)
 
-    context_dict["repositories"] = accessible_repos
+    context_dict["repositories"] = page
+    context_dict["page"] = page
+    context_dict["query"] = query
     return render(request, "index.html", context_dict)
 
 
-def read_blob(blob):
+def read_blob(repo, oid, offset=0):
     # 100K
     MAX_BLOB_SIZE = 100 * 5 << 10
-
-    content = blob.data
-    if blob.is_binary:
-        if blob.size > MAX_BLOB_SIZE:
-            return "blob_binary.html", None
-        return "blob_binary.html", utils.hex_dump(content)
+    # Binaries are paged through this many bytes at a time
+    HEX_DUMP_WINDOW = 16 << 10
+
+    # Only the parts of the blob that get displayed are inflated
+    if repo.odb.is_binary(oid):
+        stream = repo.odb.open(oid)
+        content = b"".join(stream.chunks(offset, offset + HEX_DUMP_WINDOW))
+        window = {
+            "rows": utils.hex_dump(content, base=offset),
+            "prev": max(offset - HEX_DUMP_WINDOW, 0) if offset > 0 else None,
+            "next": offset + HEX_DUMP_WINDOW if offset + HEX_DUMP_WINDOW < stream.size else None,
+        }
+        return "blob_binary.html", window
     else:
-        if blob.size > MAX_BLOB_SIZE:
+        _, size = repo.odb.info(oid)
+        if size > MAX_BLOB_SIZE:
             return "blob.html", None
-    return "blob.html", content.decode()
+    return "blob.html", repo[oid].data.decode()
 
 
 def gen_crumbs(repo_name, oid, path):
@@ -88,13 +135,26 @@ def gen_branches(repo_name, repo, oid):
             self.name = name
             self.url = url
 
-    l = list(repo.heads)
+    # Only a few branches are embedded, the rest are searched for on demand
+    l = refs.ref_table(repo.path).recent_branches(repo.odb, settings.BRANCH_SELECTOR_RECENT)
     if oid not in l:
-        l.append(oid)
+        l = [oid] + l
 
     return [Branch(name, f"/{repo_name}/view/" + name) for name in l]
 
 
+def ref_nav(request, repo_name, oid, path):
+    """Branch selector of a page, the one part that shows how the URL named the commit"""
+    db_repo_obj = get_object_or_404(Repository, name=repo_name)
+    repo = repopool.open_repository(db_repo_obj.path)
+    context = {
+        "repo_name": repo_name,
+        "ref": oid,
+        "branches": gen_branches(repo_name, repo, oid),
+    }
+    return {REF_MARKER: render_to_string("ref_nav.html", context, request)}
+
+
 def view_default(request, repo_name):
     db_repo = get_object_or_404(Repository, name=repo_name)
     branch = default_branch(db_repo)
@@ -105,44 +165,55 @@ def view_default(request, repo_name):
 
 
 @verify_user_permissions
+@conditional_on_commit("view", params=("offset", "limit"), html=True, fill=ref_nav)
 def view(request, permission, repo_name, oid, path):
     if permission == permission.NO_ACCESS:
         raise Http404("no matching repository")
 
     db_repo_obj = get_object_or_404(Repository, name=repo_name)
-    repo = mpygit.Repository(db_repo_obj.path)
+    repo = repopool.open_repository(db_repo_obj.path)
 
     # First we normalize the path so libgit2 doesn't choke
     path = utils.normalize_path(path)
 
-    commit = repo[oid]
-    if commit is None or not isinstance(commit, mpygit.Commit):
-        return HttpResponse("Invalid commit ID")
+    commit = lookup_commit(repo, oid)
+    if commit is None:
+        return HttpResponse("Invalid commit ID", status=404)
 
-    # Resolve path inside commit
-    obj = utils.resolve_path(repo, commit.tree, path)
-    if obj == None:
-        return HttpResponse("Invalid path")
+    # Resolve path inside commit, without loading what it points to yet
+    obj_oid = utils.resolve_oid(repo, commit.tree, path)
+    if obj_oid == None:
+        return HttpResponse("Invalid path", status=404)
+    obj_type, _ = repo.odb.info(obj_oid) or (None, None)
 
+    # Links use the commit itself, the page may be cached for other names of it
     context = {
         "repo_name": repo_name,
-        "oid": oid,
+        "oid": commit.oid,
+        "ref": oid,
         "path": path,
         "branches": gen_branches(repo_name, repo, oid),
-        "crumbs": gen_crumbs(repo_name, oid, path),
+        "crumbs": gen_crumbs(repo_name, commit.oid, path),
         "can_manage": permission == Permission.CAN_MANAGE,
     }
+    context.update(fill_in_context(request))
 
-    if isinstance(obj, mpygit.Tree):
-        template = "tree.html"
-        context["entries"] = utils.tree_entries(repo, commit, path, obj)
-    elif isinstance(obj, mpygit.Blob):
-        template, code = read_blob(obj)
+    if obj_type == "tree":
+        return stream_tree(request, context, repo, commit, path, repo[obj_oid])
+    elif obj_type == "blob":
+        try:
+            offset = int(request.GET.get("offset", 0))
+        except ValueError:
+            return HttpResponse("Invalid offset", status=400)
+        offset = max(offset - offset % utils.HEX_ROW_BYTES, 0)
+        template, code = read_blob(repo, obj_oid, offset)
         if template == "blob.html":
-            context["code"] = utils.highlight_code(path, code)
+            context["code"] = utils.highlight_code(path, code, obj_oid)
         else:
             context["code"] = code
-        commit = gitutil.get_latest_change(repo, commit.oid, utils.split_path(path))
+        commit = history.get_latest_change(
+            repo, commit.oid, utils.split_path(path), changeindex.open_index(repo.path)
+        )
         context["change"] = commit
     else:
         return HttpResponse("Unsupported object type")
@@ -150,6 +221,98 @@ def view(request, permission, repo_name, oid, path):
     return render(request, template, context=context)
 
 
+def stream_tree(request, context, repo, commit, path, tree):
+    """Stream a page of a tree listing, rows follow once they are annotated"""
+    try:
+        offset = max(int(request.GET.get("offset", 0)), 0)
+        limit = int(request.GET.get("limit", settings.TREE_PAGE_SIZE))
+    except ValueError:
+        return HttpResponse("Invalid offset or limit", status=400)
+    limit = max(1, min(limit, settings.TREE_MAX_PAGE_SIZE))
+
+    entries, total = utils.tree_page(tree, offset, limit)
+    context["rows_marker"] = TREE_ROWS_MARKER
+    context["total"] = total
+    context["first"] = offset + 1 if entries else offset
+    context["last"] = offset + len(entries)
+    context["limit"] = limit
+    context["prev_offset"] = max(offset - limit, 0) if offset > 0 else None
+    context["next_offset"] = offset + limit if offset + limit < total else None
+    head, tail = render_to_string("tree.html", context, request).split(TREE_ROWS_MARKER, 1)
+
+    def chunks():
+        yield head
+        # Only the entries on this page get their last change looked up
+        rows = utils.tree_entries(repo, commit, path, entries)
+        for start in range(0, len(rows), TREE_ROWS_PER_CHUNK):
+            yield render_to_string(
+                "tree_rows.html",
+                {
+                    "repo_name": context["repo_name"],
+                    "rows": rows[start : start + TREE_ROWS_PER_CHUNK],
+                },
+                request,
+            )
+        yield tail
+
+    return StreamingHttpResponse(chunks())
+
+
+@verify_user_permissions
+@conditional_on_commit("raw")
+def raw(request, permission, repo_name, oid, path):
+    if permission == permission.NO_ACCESS:
+        raise Http404("no matching repository")
+
+    db_repo_obj = get_object_or_404(Repository, name=repo_name)
+    repo = repopool.open_repository(db_repo_obj.path)
+
+    path = utils.normalize_path(path)
+
+    commit = lookup_commit(repo, oid)
+    if commit is None:
+        return HttpResponse("Invalid commit ID", status=404)
+
+    blob_oid = utils.resolve_oid(repo, commit.tree, path)
+    stream = repo.odb.open(blob_oid) if blob_oid is not None else None
+    if stream is None or stream.type != "blob":
+        return HttpResponse("Invalid path", status=404)
+
+    start, end = 0, stream.size
+    status = 200
+    if "Range" in request.headers:
+        try:
+            byte_range = utils.parse_range(request.headers["Range"], stream.size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{stream.size}"
+            return response
+        if byte_range is not None:
+            start, end = byte_range
+            status = 206
+
+    # Never let repository content render as active content like HTML
+    filename = path.rsplit("/", 1)[-1]
+    content_type, _ = mimetypes.guess_type(filename)
+    if content_type is not None and content_type.startswith("text/"):
+        content_type = "text/plain; charset=utf-8"
+    else:
+        content_type = "application/octet-stream"
+
+    response = StreamingHttpResponse(
+        stream.chunks(start, end), status=status, content_type=content_type
+    )
+    response["Content-Length"] = str(end - start)
+    response["Accept-Ranges"] = "bytes"
+    if status == 206:
+        response["Content-Range"] = f"bytes {start}-{end - 1}/{stream.size}"
+    if content_type == "application/octet-stream":
+        response["Content-Disposition"] = 'attachment; filename="{}"'.format(
+            filename.replace('"', "")
+        )
+    return response
+
+
 def user_login(request):
     context = {}
     if request.method == "POST":
@@ -229,45 +392,116 @@ def user_profile(request):
     return render(request, 'profile.html', context)
 
 @verify_user_permissions
+@conditional_on_commit("info", html=True)
 def info(request, permission, repo_name, oid):
     class FileChange:
-        def __init__(self, path, patch, status):
-            self.path = path
-            self.patch = utils.highlight_code("name.diff", patch)
-            self.status = status
-            self.deleted = status == "D"
-
-            # The line stats are not very elegant but difflib is kind of limited
-            insert = len(re.findall(r"^\+", patch, re.MULTILINE)) - 1
-            delete = len(re.findall(r"^-", patch, re.MULTILINE)) - 1
-            self.insertion = f"++{insert}"
-            self.deletion = f"--{delete}"
+        def __init__(self, result):
+            self.path = result.path
+            self.old_path = result.old_path
+            self.similarity = result.similarity
+            self.note = result.note
+            self.status = result.status
+            self.deleted = result.status == "D"
+            self.insertion = ""
+            self.deletion = ""
+            self.empty = False
+            self.collapsed = True
+
+            if result.insertions is not None:
+                self.insertion = f"++{result.insertions}"
+                self.deletion = f"--{result.deletions}"
+                changed = result.insertions + result.deletions
+                self.empty = changed == 0
+                self.collapsed = changed > settings.DIFF_COLLAPSE_LINES
 
     if permission == permission.NO_ACCESS:
         raise Http404("no matching repository")
 
     db_repo_obj = get_object_or_404(Repository, name=repo_name)
-    repo = mpygit.Repository(db_repo_obj.path)
+    repo = repopool.open_repository(db_repo_obj.path)
 
-    commit = repo[oid]
-    if commit is None or not isinstance(commit, mpygit.Commit):
-        return HttpResponse("Invalid branch or commit ID")
+    commit = lookup_commit(repo, oid)
+    if commit is None:
+        return HttpResponse("Invalid branch or commit ID", status=404)
 
-    changes = []
+    # Patches are fetched per file by the page, the files are listed and
+    # their lines counted here only for as long as the budget allows
     parent = repo[commit.parents[0]] if len(commit.parents) > 0 else None
-    diffs = gitutil.diff_commits(repo, parent, commit)
-    for path, patch, status in diffs:
-        changes.append(FileChange(path, patch, status))
+    diffs, complete = diff.diff_commits(
+        repo, parent, commit, patches=False, budget=settings.DIFF_STATS_BUDGET_SECONDS
+    )
 
     context = {
         "repo_name": repo_name,
-        "oid": oid,
+        "oid": commit.oid,
         "commit": commit,
-        "changes": changes,
+        "changes": [FileChange(result) for result in diffs],
+        "complete": complete,
         "can_manage": permission == Permission.CAN_MANAGE,
     }
+    context.update(fill_in_context(request))
+
+    response = render(request, "commit.html", context=context)
+    if not complete:
+        mark_incomplete(response)
+    return response
+
+
+@verify_user_permissions
+@conditional_on_commit("file_diff")
+def file_diff(request, permission, repo_name, oid, path):
+    """Highlighted patch of one file changed by a commit, for the commit page"""
+    if permission == permission.NO_ACCESS:
+        raise Http404("no matching repository")
+
+    db_repo_obj = get_object_or_404(Repository, name=repo_name)
+    repo = repopool.open_repository(db_repo_obj.path)
+
+    commit = lookup_commit(repo, oid)
+    if commit is None:
+        raise Http404("invalid branch or commit ID")
+
+    parent = repo[commit.parents[0]] if len(commit.parents) > 0 else None
+    path = path.strip("/")
+    result = diff.diff_path(repo, parent, commit, path)
+    if result is None:
+        raise Http404("file not changed by commit")
+    if result.patch is None:
+        response = HttpResponse(format_html("<p>{}</p>", result.note))
+        if result.timed_out:
+            mark_incomplete(response)
+        return response
+
+    patch = utils.highlight_code("name.diff", result.patch, oid=f"{commit.oid}:{path}")
+    return HttpResponse(patch)
 
-    return render(request, "commit.html", context=context)
+
+@verify_user_permissions
+def ref_search(request, permission, repo_name):
+    """JSON page of the branches and tags whose names start with ?q="""
+    if permission == permission.NO_ACCESS:
+        raise Http404("no matching repository")
+
+    db_repo_obj = get_object_or_404(Repository, name=repo_name)
+    try:
+        offset = max(int(request.GET.get("offset", 0)), 0)
+        limit = int(request.GET.get("limit", settings.REF_SEARCH_PAGE_SIZE))
+    except ValueError:
+        return HttpResponse("Invalid offset or limit", status=400)
+    limit = max(1, min(limit, settings.REF_SEARCH_PAGE_SIZE))
+
+    matches, more = refs.ref_table(db_repo_obj.path).search(
+        request.GET.get("q", ""), offset, limit
+    )
+    return JsonResponse(
+        {
+            "refs": [
+                {"name": name, "kind": kind, "url": f"/{repo_name}/view/" + name}
+                for name, kind in matches
+            ],
+            "next_offset": offset + limit if more else None,
+        }
+    )
 
 
 def chain_default(request, repo_name):
@@ -284,16 +518,38 @@ def chain(request, permission, repo_name, oid):
 
     db_repo_obj = get_object_or_404(Repository, name=repo_name)
     # Open a repo object to the requested repo
-    repo = mpygit.Repository(db_repo_obj.path)
+    repo = repopool.open_repository(db_repo_obj.path)
 
-    obj = repo[oid]
+    obj = lookup_commit(repo, oid)
     if obj is None:
         return HttpResponse("Invalid branch or commit ID")
 
+    after = request.GET.get("after")
+    if after is not None and not odb.oid_re.fullmatch(after):
+        return HttpResponse("Invalid cursor", status=400)
+    try:
+        page_size = int(request.GET.get("n", settings.CHAIN_PAGE_SIZE))
+    except ValueError:
+        return HttpResponse("Invalid page size", status=400)
+    page_size = max(1, min(page_size, settings.CHAIN_MAX_PAGE_SIZE))
+
+    walk = history.resume_walk(repo, obj.oid, after)
+    commits = [
+        odb.CommitSummary(commit.oid, repo.odb.read(commit.oid)[1])
+        for commit in itertools.islice(walk, page_size)
+    ]
+
+    next_after = None
+    if len(commits) == page_size and walk.frontier:
+        next_after = commits[-1].oid
+        history.save_walk(repo, obj.oid, next_after, walk)
+
     context = {
         "repo_name": repo_name,
         "oid": oid,
-        "commits": gitutil.walk(repo, obj.oid, 100),
+        "commits": commits,
+        "next_after": next_after,
+        "page_size": page_size,
         "can_manage": permission == Permission.CAN_MANAGE,
     }
     return render(request, "chain.html", context=context)
@@ -328,25 +584,40 @@ def manage_repo(request, permission, repo_name):
             return HttpResponse("malformed payload", status=400)
         return HttpResponse(status=200)
 
+    # One query for the whole page, grants are left joined onto the profiles
+    profiles = (
+        UserProfile.objects.annotate(
+            access=FilteredRelation("canaccess", condition=Q(canaccess__repo=db_repo))
+        )
+        .values("id", "user__username", "user__email", "access__id", "access__canManage")
+        .order_by("user__username", "id")
+    )
+    query = request.GET.get("q", "").strip()
+    if query:
+        profiles = profiles.filter(
+            Q(user__username__icontains=query) | Q(user__email__icontains=query)
+        )
+    page = Paginator(profiles, settings.MANAGE_USERS_PAGE_SIZE).get_page(request.GET.get("page"))
+
     users = []
-    for profile in UserProfile.objects.all():
+    for profile in page:
         permission = Permission.NO_ACCESS
-        try:
-            access = CanAccess.objects.get(repo=db_repo, user=profile)
-            if access.canManage:
+        if profile["access__id"] is not None:
+            if profile["access__canManage"]:
                 permission = Permission.CAN_MANAGE
             else:
                 permission = Permission.CAN_VIEW
-        except CanAccess.DoesNotExist:
-            pass
-
         users.append(
-            UserPerm(profile.id, profile.user.username, profile.user.email, permission)
+            UserPerm(
+                profile["id"], profile["user__username"], profile["user__email"], permission
+            )
         )
 
     context = {
         "repo_name": repo_name,
         "users": users,
+        "page": page,
+        "query": query,
         "is_public": db_repo.isPublic,
         "oid": default_branch(db_repo),
         "can_manage": True,
@@ -355,35 +626,56 @@ def manage_repo(request, permission, repo_name):
 
 
 def update_profile_permissions(repo, manager, payload):
-    def get_entry(name, type):
+    """Apply one change or a batch of them under "changes" in one transaction"""
+
+    def get_entry(change, name, type):
         # let KeyError bubble up to callsite
-        val = payload[name]
+        val = change[name]
         if not isinstance(val, type):
             raise TypeError
         return val
 
-    user_id = get_entry("id", str)
-    try:
-        user_id = int(user_id)
-        profile = UserProfile.objects.get(id=user_id)
-    except UserProfile.DoesNotExist:
-        raise ValueError
+    changes = payload["changes"] if "changes" in payload else [payload]
+    if not isinstance(changes, list):
+        raise TypeError
 
-    if manager == profile:
-        raise ValueError("cannot change own permissions")
+    requested = {}
+    for change in changes:
+        if not isinstance(change, dict):
+            raise TypeError
+        user_id = int(get_entry(change, "id", str))
+        requested[user_id] = (get_entry(change, "visible", bool), get_entry(change, "manage", bool))
 
-    visible = get_entry("visible", bool)
-    manage = get_entry("manage", bool)
+    if UserProfile.objects.filter(id__in=requested).count() != len(requested):
+        raise ValueError("no such user")
+    if manager.id in requested:
+        raise ValueError("cannot change own permissions")
 
-    if visible:
-        CanAccess.objects.update_or_create(
-            user=profile, repo=repo, defaults={"canManage": manage}
-        )
-    else:
-        try:
-            CanAccess.objects.get(user=profile, repo=repo).delete()
-        except CanAccess.DoesNotExist:
-            pass
+    with transaction.atomic():
+        existing = {
+            access.user_id: access
+            for access in CanAccess.objects.select_for_update().filter(
+                repo=repo, user_id__in=requested
+            )
+        }
+        created, updated, removed = [], [], []
+        for user_id, (visible, manage) in requested.items():
+            access = existing.get(user_id)
+            if not visible:
+                if access is not None:
+                    removed.append(access.id)
+            elif access is None:
+                created.append(CanAccess(user_id=user_id, repo=repo, canManage=manage))
+            elif access.canManage != manage:
+                access.canManage = manage
+                updated.append(access)
+
+        CanAccess.objects.bulk_create(created)
+        CanAccess.objects.bulk_update(updated, ["canManage"])
+        CanAccess.objects.filter(id__in=removed).delete()
+
+    # Bulk writes do not send the signals that keep permission maps current
+    permissions.invalidate()
 
 
 def update_repo_visibility(repo, payload):
@@ -405,10 +697,11 @@ def update_repo_visibility(repo, payload):
 def manage(request):
     if request.user.is_superuser:
         context_dict = {}
-        repos = Repository.objects.all()
-        for repo in repos:
-            repo.default_branch = default_branch(repo)
-        context_dict['repositories'] = repos
+        repos = Repository.objects.select_related("summary").order_by("name")
+        page = Paginator(repos, settings.DASHBOARD_PAGE_SIZE).get_page(request.GET.get("page"))
+        summaries.refresh(page)
+        context_dict['repositories'] = page
+        context_dict['page'] = page
         return render(request, "manage.html", context=context_dict)
 
     else: